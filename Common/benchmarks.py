@@ -0,0 +1,518 @@
+"""
+
+Copyright 2019, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Offline benchmarks for the ETL helpers in notebooks.py. Everything runs against the stand-ins in
+# fake_backends.py, on synthetic inputs, so timings can be compared from one change to the next:
+#
+#   python3 benchmarks.py --work-dir /tmp/nb-bench --files 500 --rows 2000 --threads 8 --latency 0.01
+#
+# Stages: indexd (build_pull_list_with_indexd against the stub), pull (BucketPuller from the directory
+# object store), concat (concat_all_files over the pulled TSVs), maf (read_MAFs + write_MAFs).
+#
+# The merge suite is a regression check for the MAF merge path, with wall time, rows/sec and peak RSS
+# per stage. The first run saves the baseline; later runs exit 1 if a stage got slower or bigger:
+#
+#   python3 benchmarks.py --suite merge --maf-rows 50000 --col-count 120 --gz --repeat 3 --baseline merge.json
+#
+# The import suite times a cold "import notebooks" in fresh interpreters and exits 1 if it is over
+# --import-budget seconds or if it pulled in the cloud SDKs, which should only load on first use:
+#
+#   python3 benchmarks.py --suite import --import-budget 0.15
+#
+
+import os
+import sys
+import time
+import random
+import shutil
+import filecmp
+import gzip
+import subprocess
+import argparse
+from json import loads as json_loads, dumps as json_dumps
+
+import notebooks
+import fake_backends
+
+MAF_BASE_COLS = ['Hugo_Symbol', 'Entrez_Gene_Id', 'Center', 'NCBI_Build', 'Chromosome', 'Start_Position',
+                 'End_Position', 'Strand', 'Variant_Classification', 'Variant_Type', 'Reference_Allele',
+                 'Tumor_Seq_Allele1', 'Tumor_Seq_Allele2', 'Tumor_Sample_Barcode', 'Matched_Norm_Sample_Barcode']
+MAF_KEY_FIELDS = ['Chromosome', 'Start_Position', 'End_Position', 'Reference_Allele', 'Tumor_Seq_Allele2',
+                  'Tumor_Sample_Barcode']
+MAF_EXTRA_COLS = ['project_short_name', 'caller', 'file_gdc_id']
+STAGES = ['indexd', 'pull', 'concat', 'maf']
+LAZY_IMPORTS = ['google.cloud.bigquery', 'google.cloud.storage', 'requests']
+
+
+def synthetic_tsv(rng, rows, cols):
+    """
+    One GDC-style per-sample TSV (a gene expression quantification look-alike) as bytes
+    """
+    lines = ["# synthetic\n", "gene_id\t" + "\t".join("value_{}".format(i) for i in range(1, cols)) + "\n"]
+    for row in range(rows):
+        vals = ["ENSG{:011d}.{}".format(row, rng.randint(1, 20))]
+        for col in range(1, cols):
+            vals.append(str(rng.randint(0, 5000)) if col % 2 else "{:.4f}".format(rng.random() * 100))
+        lines.append("\t".join(vals) + "\n")
+    return "".join(lines).encode('utf-8')
+
+
+def write_synthetic_mafs(out_dir, tumors, callers, rows, col_count=None, overlap=0.8, disagree=0.1, gz=False,
+                         program_prefix='TCGA-', seed=1):
+    """
+    Multi-caller MAFs, one per (tumor, caller), named <program_prefix><tumor>.<caller>.maf (.maf.gz with
+    gz). Each tumor gets rows mutations; a mutation is reported by every caller with probability overlap,
+    else by one caller picked at random. Where several callers report a mutation, each one disagrees on
+    Variant_Classification with probability disagree, so write_MAFs has real merging to do. Files have
+    col_count columns (the col_count to give read_MAFs): the standard MAF columns first, then filler.
+    Returns the file names, tumor by tumor.
+    """
+    tumors = [tumors] if isinstance(tumors, str) else list(tumors)
+    col_count = len(MAF_BASE_COLS) if col_count is None else col_count
+    if col_count < len(MAF_BASE_COLS):
+        raise ValueError("col_count must be at least {}".format(len(MAF_BASE_COLS)))
+    header = MAF_BASE_COLS + ["synthetic_col_{}".format(i) for i in range(len(MAF_BASE_COLS), col_count)]
+    filler_pool = ['', '.', 'PASS', 'common_variant', '0', '1', 'NA'] + [str(i) for i in range(50)]
+    vc_index = MAF_BASE_COLS.index('Variant_Classification')
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    files = []
+    for tumor in tumors:
+        per_caller = {caller: [] for caller in callers}
+        for row in range(rows):
+            ref_allele = rng.choice('ACGT')
+            vals = ["GENE{}".format(rng.randint(0, 2000)), str(rng.randint(1, 100000)), 'BI', 'GRCh38',
+                    "chr{}".format(rng.randint(1, 22)), str(row * 10 + 1), str(row * 10 + 1), '+',
+                    rng.choice(['Missense_Mutation', 'Silent', 'Nonsense_Mutation']), 'SNP', ref_allele,
+                    ref_allele, rng.choice('ACGT'),
+                    "{}{}-{:02d}-{:04d}-01A".format(program_prefix, tumor, rng.randint(0, 99),
+                                                    rng.randint(0, max(rows // 5, 1))), 'normal']
+            vals += [rng.choice(filler_pool) for _ in range(len(MAF_BASE_COLS), col_count)]
+            # read_MAFs strips each line, so the last field can't be empty:
+            if not vals[-1]:
+                vals[-1] = 'NA'
+            if len(callers) > 1 and rng.random() < overlap:
+                reporters = callers
+            else:
+                reporters = [rng.choice(callers)]
+            for caller in reporters:
+                if len(reporters) > 1 and rng.random() < disagree:
+                    caller_vals = list(vals)
+                    caller_vals[vc_index] = "{}_{}".format(vals[vc_index], caller)
+                    per_caller[caller].append("\t".join(caller_vals) + "\n")
+                else:
+                    per_caller[caller].append("\t".join(vals) + "\n")
+
+        for caller in callers:
+            file_name = os.path.join(out_dir, "{}{}.{}.maf{}".format(program_prefix, tumor, caller,
+                                                                     '.gz' if gz else ''))
+            with (gzip.open(file_name, 'wt', compresslevel=1) if gz else open(file_name, 'w')) as maf_out:
+                maf_out.write("#version 2.4\n")
+                maf_out.write("\t".join(header) + "\n")
+                maf_out.writelines(per_caller[caller])
+            files.append(file_name)
+    return files
+
+
+def synthetic_tsv_file_info(filename, program_prefix):
+    """
+    file_info_func for the synthetic TSVs: the sample file name becomes the one extra column
+    """
+    return [program_prefix + os.path.basename(filename)]
+
+
+def synthetic_maf_file_info(aFile, program_prefix):
+    """
+    file_info_func for write_synthetic_mafs output: [project short name, caller, file id]
+    """
+    pieces = os.path.basename(aFile).split('.')
+    return [pieces[0], pieces[1], "synthetic-{}".format(pieces[1])]
+
+
+def _timed(results, stage, func, *args, **kwargs):
+    start = time.time()
+    cpu_start = time.process_time()
+    value = func(*args, **kwargs)
+    results[stage] = {'wall': time.time() - start, 'cpu': time.process_time() - cpu_start}
+    return value
+
+
+def run_benchmarks(work_dir, num_files=200, rows=1000, cols=6, threads=8, procs=1, latency=0.0, fail_rate=0.0,
+                   maf_rows=20000, callers=('mutect', 'muse', 'varscan', 'pindel'), stages=None, seed=1,
+                   metrics=None):
+    """
+    Build the synthetic inputs under work_dir (which is cleared first), run the chosen stages (and the
+    ones they need inputs from), and return a dict of {stage: {wall, cpu, and whatever the stage
+    counts}}. The helpers report into metrics (a quiet PipelineMetrics by default).
+    """
+    stages = STAGES if stages is None else stages
+    metrics = notebooks.PipelineMetrics('benchmarks') if metrics is None else metrics
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    rng = random.Random(seed)
+    store = fake_backends.DirectoryStorageClient(os.path.join(work_dir, 'gcs'), latency=latency,
+                                                 fail_rate=fail_rate, seed=seed)
+    notebooks.set_backends(storage_factory=lambda: store)
+    results = {}
+    try:
+        files = [("sample_{:06d}.tsv".format(i), synthetic_tsv(rng, rows, cols)) for i in range(num_files)]
+        records = fake_backends.stock_object_store(store, 'gdc-synthetic', files)
+        manifest_file = os.path.join(work_dir, 'manifest.tsv')
+        fake_backends.write_manifest(records, manifest_file)
+        pull_list_file = os.path.join(work_dir, 'pull_list.txt')
+        local_dir = os.path.join(work_dir, 'local')
+        one_big_tsv = os.path.join(work_dir, 'combined.tsv')
+        total_bytes = sum(rec['size'] for rec in records)
+
+        if 'indexd' in stages or 'pull' in stages or 'concat' in stages:
+            with fake_backends.GDCStubServer(records, latency=latency, fail_rate=fail_rate, seed=seed) as stub:
+                _timed(results, 'indexd', notebooks.build_pull_list_with_indexd, manifest_file, 100,
+                       stub.indexd_url, pull_list_file, num_workers=threads)
+            results['indexd']['files'] = len(records)
+
+        if 'pull' in stages or 'concat' in stages:
+            with open(pull_list_file, 'r') as pull_in:
+                pull_list = [line.rstrip('\n') for line in pull_in if line.strip()]
+            puller = notebooks.BucketPuller(threads, retry_backoff=0.01, metrics=metrics)
+            ok = _timed(results, 'pull', puller.pull_from_buckets, pull_list, local_dir,
+                        manifest_file=manifest_file)
+            results['pull'].update({'files': len(pull_list), 'bytes': total_bytes, 'ok': ok})
+
+        if 'concat' in stages:
+            all_files = notebooks.build_file_list(local_dir)
+            _timed(results, 'concat', notebooks.concat_all_files, all_files, one_big_tsv, 'SYN-', ['sample_file'],
+                   synthetic_tsv_file_info, None, num_procs=procs, metrics=metrics)
+            results['concat'].update({'files': len(all_files), 'bytes': os.path.getsize(one_big_tsv)})
+
+        if 'maf' in stages:
+            maf_dir = os.path.join(work_dir, 'maf')
+            maf_files = write_synthetic_mafs(maf_dir, ['BRCA'], list(callers), maf_rows, seed=seed)
+            cwd = os.getcwd()
+            os.chdir(maf_dir)  # read_MAFs and write_MAFs write their logs and output here
+            try:
+                start = time.time()
+                cpu_start = time.process_time()
+                mut_calls, hdr_pick = notebooks.read_MAFs('BRCA', maf_files, 'TCGA-', MAF_EXTRA_COLS,
+                                                          len(MAF_BASE_COLS), False, MAF_KEY_FIELDS,
+                                                          MAF_BASE_COLS[0], synthetic_maf_file_info,
+                                                          num_procs=procs, metrics=metrics)
+                notebooks.write_MAFs('BRCA', mut_calls, hdr_pick, list(callers), False)
+                results['maf'] = {'wall': time.time() - start, 'cpu': time.process_time() - cpu_start,
+                                  'files': len(maf_files), 'rows': len(mut_calls)}
+            finally:
+                os.chdir(cwd)
+    finally:
+        notebooks.set_backends()
+
+    for stage_result in results.values():
+        if 'bytes' in stage_result:
+            stage_result['mb_per_sec'] = stage_result['bytes'] / max(stage_result['wall'], 1e-6) / 1e6
+    return results
+
+
+def _reset_peak_rss():
+    """
+    Reset the kernel's peak RSS mark for this process (Linux only). Returns False where that can't be
+    done, in which case the peaks reported are for the whole run so far.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as refs_out:
+            refs_out.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as status_in:
+            for line in status_in:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def _measure(stage_results, stage, func, *args, **kwargs):
+    """
+    Run func, adding its wall and CPU time and its peak RSS into stage_results[stage]
+    """
+    rss_reset = _reset_peak_rss()
+    start = time.time()
+    cpu_start = time.process_time()
+    value = func(*args, **kwargs)
+    res = stage_results.setdefault(stage, {'wall': 0.0, 'cpu': 0.0, 'rows': 0, 'peak_rss_mb': 0.0})
+    res['wall'] += time.time() - start
+    res['cpu'] += time.process_time() - cpu_start
+    res['peak_rss_mb'] = max(res['peak_rss_mb'], _peak_rss_mb())
+    res['rss_reset'] = rss_reset
+    return value
+
+
+def run_merge_benchmarks(work_dir, tumors=('BRCA', 'LUAD', 'UCEC'), callers=('mutect', 'muse', 'varscan', 'pindel'),
+                         rows=20000, col_count=120, overlap=0.8, gz=True, program_prefix='TCGA-', procs=1,
+                         compact=False, external=False, repeat=1, seed=1):
+    """
+    Regression benchmark for the MAF merge path. Writes a synthetic corpus under work_dir (cleared
+    first), then times read_MAFs, write_MAFs, concat_all_merged_files (and merge_MAFs_external, with
+    external) over it, repeat times. Returns {'config': ..., 'stages': {stage: {wall, cpu, rows,
+    rows_per_sec, peak_rss_mb}}, 'mismatches': [...]} with the fastest wall time of the repeats for each
+    stage. With external, each merge_MAFs_external output is compared with the write_MAFs one, and the
+    tumors where they differ are listed in mismatches.
+    """
+    shutil.rmtree(work_dir, ignore_errors=True)
+    maf_dir = os.path.join(work_dir, 'maf')
+    out_dir = os.path.join(work_dir, 'out')
+    os.makedirs(out_dir)
+    tumors = list(tumors)
+    callers = list(callers)
+    config = {'tumors': tumors, 'callers': callers, 'rows': rows, 'col_count': col_count, 'overlap': overlap,
+              'gz': gz, 'program_prefix': program_prefix, 'procs': procs, 'compact': compact,
+              'external': external, 'seed': seed}
+    maf_files = write_synthetic_mafs(maf_dir, tumors, callers, rows, col_count, overlap, gz=gz,
+                                     program_prefix=program_prefix, seed=seed)
+
+    best = {}
+    mismatches = []
+    cwd = os.getcwd()
+    os.chdir(out_dir)  # read_MAFs and write_MAFs write their logs and output here
+    try:
+        for run in range(repeat):
+            stages = {}
+            metrics = notebooks.PipelineMetrics('merge')
+            merged_files = []
+            for tumor in tumors:
+                mut_calls, hdr_pick = _measure(stages, 'read_MAFs', notebooks.read_MAFs, tumor, maf_files,
+                                               program_prefix, MAF_EXTRA_COLS, col_count, False, MAF_KEY_FIELDS,
+                                               MAF_BASE_COLS[0], synthetic_maf_file_info, num_procs=procs,
+                                               compact=compact, metrics=metrics)
+                stages['read_MAFs']['rows'] += sum(len(calls) for calls in mut_calls.values())
+                _measure(stages, 'write_MAFs', notebooks.write_MAFs, tumor, mut_calls, hdr_pick, callers, False)
+                stages['write_MAFs']['rows'] += len(mut_calls)
+                mut_calls = None
+                merged_files.append(os.path.join(out_dir, "mergeA.{}.maf".format(tumor)))
+                if external:
+                    shutil.move(merged_files[-1], merged_files[-1] + '.in_memory')
+                    _measure(stages, 'merge_external', notebooks.merge_MAFs_external, tumor, maf_files,
+                             program_prefix, MAF_EXTRA_COLS, col_count, False, MAF_KEY_FIELDS, MAF_BASE_COLS[0],
+                             synthetic_maf_file_info, callers)
+                    if not filecmp.cmp(merged_files[-1], merged_files[-1] + '.in_memory', shallow=False):
+                        print("MISMATCH: merge_MAFs_external and write_MAFs disagree for {}".format(tumor))
+                        if tumor not in mismatches:
+                            mismatches.append(tumor)
+                    shutil.move(merged_files[-1] + '.in_memory', merged_files[-1])
+            if external:
+                stages['merge_external']['rows'] = stages['write_MAFs']['rows']
+            one_big_tsv = os.path.join(out_dir, 'all_merged.maf')
+            _measure(stages, 'concat_merged', notebooks.concat_all_merged_files, merged_files, one_big_tsv)
+            with open(one_big_tsv, 'r') as merged_in:
+                # concat_all_merged_files drops the headers, so every line is a row
+                stages['concat_merged']['rows'] = sum(1 for _ in merged_in)
+            for stage, res in stages.items():
+                if stage not in best or res['wall'] < best[stage]['wall']:
+                    best[stage] = res
+    finally:
+        os.chdir(cwd)
+
+    for res in best.values():
+        res['rows_per_sec'] = res['rows'] / max(res['wall'], 1e-6)
+    return {'config': config, 'stages': best, 'mismatches': mismatches}
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Compare a run_merge_benchmarks result with a saved one. A stage regresses if its wall time or peak
+    RSS went up by more than tolerance (as a fraction). Returns a list of (stage, metric, baseline
+    value, new value) for the regressions.
+    """
+    if results['config'] != baseline['config']:
+        print("WARNING: baseline was made with a different configuration: {}".format(baseline['config']))
+    regressions = []
+    print("{:16s} {:>10s} {:>10s} {:>8s} {:>12s} {:>10s} {:>10s} {:>8s}".format(
+        'stage', 'base s', 'now s', 'change', 'rows/s', 'base MB', 'now MB', 'change'))
+    for stage, res in results['stages'].items():
+        base = baseline['stages'].get(stage)
+        if base is None:
+            print("{:16s} (not in baseline)".format(stage))
+            continue
+        wall_change = res['wall'] / max(base['wall'], 1e-6) - 1.0
+        rss_change = res['peak_rss_mb'] / max(base['peak_rss_mb'], 1e-6) - 1.0
+        print("{:16s} {:10.3f} {:10.3f} {:+7.1f}% {:12.0f} {:10.1f} {:10.1f} {:+7.1f}%".format(
+            stage, base['wall'], res['wall'], 100 * wall_change, res['rows_per_sec'], base['peak_rss_mb'],
+            res['peak_rss_mb'], 100 * rss_change))
+        if wall_change > tolerance:
+            regressions.append((stage, 'wall', base['wall'], res['wall']))
+        if rss_change > tolerance:
+            regressions.append((stage, 'peak_rss_mb', base['peak_rss_mb'], res['peak_rss_mb']))
+    for stage, metric, base_val, new_val in regressions:
+        print("REGRESSION: {} {} {:.3f} -> {:.3f}".format(stage, metric, base_val, new_val))
+    return regressions
+
+
+_IMPORT_PROBE = """
+import sys, time
+sys.path.insert(0, {common_dir!r})
+start = time.perf_counter()
+import notebooks
+took = time.perf_counter() - start
+print(repr(took))
+print(','.join(mod for mod in {heavy!r} if mod in sys.modules))
+"""
+
+
+def run_import_benchmark(repeat=5, budget=0.15):
+    """
+    Time "import notebooks" in fresh interpreters (so nothing is already in sys.modules) and keep the
+    fastest of repeat runs. Fails if that is over budget seconds, or if any module in LAZY_IMPORTS was
+    loaded by the import. On failure the slowest imports from -X importtime are printed.
+    """
+    probe = _IMPORT_PROBE.format(common_dir=os.path.dirname(os.path.abspath(__file__)), heavy=LAZY_IMPORTS)
+    best = None
+    loaded = []
+    import_times = None
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe], capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(proc.stderr)
+            return {'import_s': None, 'budget_s': budget, 'loaded': [], 'ok': False}
+        took, heavy = proc.stdout.splitlines()[-2:]
+        took = float(took)
+        if best is None or took < best:
+            best = took
+            loaded = [mod for mod in heavy.split(',') if mod]
+            import_times = proc.stderr
+    ok = best <= budget and not loaded
+    print("import notebooks: {:.3f} s (budget {:.3f} s), best of {}".format(best, budget, repeat))
+    for mod in loaded:
+        print("EAGER IMPORT: {}".format(mod))
+    if not ok:
+        rows = []
+        for line in import_times.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[1].strip().isdigit():
+                rows.append((int(fields[1]), fields[2].rstrip()))
+        for cumulative, mod in sorted(rows, reverse=True)[:10]:
+            print("{:10.3f} s {}".format(cumulative / 1e6, mod))
+        print("REGRESSION: import time over budget" if best > budget else "REGRESSION: eager imports")
+    return {'import_s': best, 'budget_s': budget, 'loaded': loaded, 'ok': ok}
+
+
+def print_merge_results(results):
+    print("{:16s} {:>9s} {:>9s} {:>10s} {:>12s} {:>10s}".format('stage', 'wall s', 'cpu s', 'rows', 'rows/s',
+                                                               'peak MB'))
+    for stage, res in results['stages'].items():
+        print("{:16s} {:9.3f} {:9.3f} {:10d} {:12.0f} {:10.1f}".format(stage, res['wall'], res['cpu'], res['rows'],
+                                                                      res['rows_per_sec'], res['peak_rss_mb']))
+    return
+
+
+def print_results(results):
+    print("{:8s} {:>9s} {:>9s} {:>8s} {:>10s}".format('stage', 'wall s', 'cpu s', 'files', 'MB/s'))
+    for stage in STAGES:
+        if stage in results:
+            res = results[stage]
+            print("{:8s} {:9.2f} {:9.2f} {:8d} {:>10s}".format(
+                stage, res['wall'], res['cpu'], res.get('files', 0),
+                "{:.1f}".format(res['mb_per_sec']) if 'mb_per_sec' in res else '-'))
+    return
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the notebooks.py ETL helpers")
+    parser.add_argument('--suite', choices=['pipeline', 'merge', 'import'], default='pipeline')
+    parser.add_argument('--work-dir', default='/tmp/notebooks-bench')
+    parser.add_argument('--files', type=int, default=200, help="number of per-sample TSVs")
+    parser.add_argument('--rows', type=int, default=1000, help="rows per TSV")
+    parser.add_argument('--cols', type=int, default=6, help="columns per TSV")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--procs', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each fake service call")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="fraction of fake calls that fail")
+    parser.add_argument('--maf-rows', type=int, default=20000, help="mutations per tumor in the synthetic MAFs")
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--tumors', default='BRCA,LUAD,UCEC', help="merge suite: tumor types")
+    parser.add_argument('--callers', default='mutect,muse,varscan,pindel', help="merge suite: callers")
+    parser.add_argument('--col-count', type=int, default=120, help="merge suite: MAF columns")
+    parser.add_argument('--overlap', type=float, default=0.8,
+                        help="merge suite: fraction of mutations reported by every caller")
+    parser.add_argument('--gz', action='store_true', help="merge suite: gzip the MAFs")
+    parser.add_argument('--program-prefix', default='TCGA-')
+    parser.add_argument('--compact', action='store_true', help="merge suite: read_MAFs(compact=True)")
+    parser.add_argument('--external', action='store_true', help="merge suite: also time merge_MAFs_external")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="merge and import suites: keep the fastest of this many runs (import: at least 5)")
+    parser.add_argument('--baseline', default=None, help="merge suite: compare against this saved result")
+    parser.add_argument('--save-baseline', action='store_true', help="merge suite: write the result as --baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="merge suite: allowed fractional slowdown or memory growth")
+    parser.add_argument('--import-budget', type=float, default=0.15,
+                        help="import suite: seconds allowed for a cold 'import notebooks'")
+    parser.add_argument('--json', default=None, help="also write the results to this file")
+    parser.add_argument('--trace', default=None, help="write the PipelineMetrics trace to this file")
+    opts = parser.parse_args(args)
+
+    if opts.suite == 'import':
+        results = run_import_benchmark(max(opts.repeat, 5), opts.import_budget)
+        if opts.json is not None:
+            with open(opts.json, 'w') as json_out:
+                json_out.write(json_dumps(results, indent=2))
+        return 0 if results['ok'] else 1
+
+    if opts.suite == 'merge':
+        results = run_merge_benchmarks(opts.work_dir, opts.tumors.split(','), opts.callers.split(','),
+                                       opts.maf_rows, opts.col_count, opts.overlap, opts.gz, opts.program_prefix,
+                                       opts.procs, opts.compact, opts.external, opts.repeat)
+        print_merge_results(results)
+        if opts.json is not None:
+            with open(opts.json, 'w') as json_out:
+                json_out.write(json_dumps(results, indent=2))
+        if results['mismatches']:
+            print("merge_MAFs_external output differs from write_MAFs for: {}".format(
+                ', '.join(results['mismatches'])))
+            return 1
+        if opts.baseline is None:
+            return 0
+        if opts.save_baseline or not os.path.exists(opts.baseline):
+            with open(opts.baseline, 'w') as baseline_out:
+                baseline_out.write(json_dumps(results, indent=2))
+            print("saved baseline {}".format(opts.baseline))
+            return 0
+        with open(opts.baseline, 'r') as baseline_in:
+            baseline = json_loads(baseline_in.read())
+        return 1 if compare_to_baseline(results, baseline, opts.tolerance) else 0
+
+    metrics = notebooks.PipelineMetrics('benchmarks')
+    results = run_benchmarks(opts.work_dir, opts.files, opts.rows, opts.cols, opts.threads, opts.procs,
+                             opts.latency, opts.fail_rate, opts.maf_rows, stages=opts.stages.split(','),
+                             metrics=metrics)
+    print_results(results)
+    if opts.trace is not None:
+        metrics.dump_trace(opts.trace)
+    if opts.json is not None:
+        with open(opts.json, 'w') as json_out:
+            json_out.write(json_dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
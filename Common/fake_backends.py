@@ -0,0 +1,560 @@
+"""
+
+Copyright 2019, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# In-process stand-ins for the services the helpers in notebooks.py talk to, so the pipeline can be run
+# and timed with no Google project or network:
+#
+#   DirectoryStorageClient - google.cloud.storage.Client lookalike; bucket b, blob x/y is file <root>/b/x/y
+#   FakeBigQueryClient     - google.cloud.bigquery.Client lookalike; jobs finish after a set latency
+#   GDCStubServer          - local HTTP server answering the GDC files endpoint and IndexD bulk lookups
+#
+# Hook the first two in with notebooks.set_backends(), and pass the GDCStubServer URLs wherever a helper
+# takes an api_url or indexd_url. Only the calls notebooks.py makes are covered.
+#
+
+import os
+import re
+import time
+import random
+import hashlib
+import base64
+import threading
+import itertools
+import http.server
+import urllib.parse as up
+from json import dumps as json_dumps
+
+
+class _Throttle(object):
+    """
+    Per-call latency and random transient failures, shared by the fakes
+    """
+    def __init__(self, latency=0.0, fail_rate=0.0, seed=None):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def __call__(self, what):
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.fail_rate
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if fail:
+            raise IOError("injected transient failure in {}".format(what))
+
+
+class DirectoryStorageClient(object):
+    """
+    Object store served from a directory: bucket b, blob x/y is the file <root_dir>/b/x/y. Every call
+    that moves data waits latency seconds first, and fails with an IOError at fail_rate. Asking for an
+    object that is not there raises google.cloud.exceptions.NotFound, as GCS does.
+    """
+    def __init__(self, root_dir, latency=0.0, fail_rate=0.0, seed=None):
+        self.root_dir = root_dir
+        self.throttle = _Throttle(latency, fail_rate, seed)
+
+    def __str__(self):
+        return "DirectoryStorageClient"
+
+    def bucket(self, bucket_name):
+        return _DirectoryBucket(self, bucket_name)
+
+    def get_bucket(self, bucket_name):
+        return self.bucket(bucket_name)
+
+    def list_blobs(self, bucket_name, prefix=''):
+        base = os.path.join(self.root_dir, bucket_name)
+        blobs = []
+        for path, dirs, files in os.walk(base):
+            for file_name in files:
+                name = os.path.relpath(os.path.join(path, file_name), base).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    blobs.append(_DirectoryBlob(self, bucket_name, name))
+        return sorted(blobs, key=lambda blob: blob.name)
+
+    def path_for(self, bucket_name, blob_name):
+        return os.path.join(self.root_dir, bucket_name, blob_name)
+
+    def put(self, bucket_name, blob_name, data):
+        """
+        Drop an object straight into the store (no latency, no failures), for setting up inputs
+        """
+        full_file = self.path_for(bucket_name, blob_name)
+        os.makedirs(os.path.dirname(full_file), exist_ok=True)
+        with open(full_file, 'wb') as obj_out:
+            obj_out.write(data)
+        return "gs://{}/{}".format(bucket_name, blob_name)
+
+
+class _DirectoryBucket(object):
+    def __init__(self, client, name):
+        self._client = client
+        self.name = name
+
+    def blob(self, blob_name):
+        return _DirectoryBlob(self._client, self.name, blob_name)
+
+    def get_blob(self, blob_name):
+        blob = self.blob(blob_name)
+        return blob if blob.exists() else None
+
+
+class _DirectoryBlob(object):
+    def __init__(self, client, bucket_name, name):
+        self._client = client
+        self.bucket_name = bucket_name
+        self.name = name
+
+    def _path(self):
+        return self._client.path_for(self.bucket_name, self.name)
+
+    def _write(self, data):
+        # Write then rename, so a reader never sees half an object:
+        full_file = self._path()
+        os.makedirs(os.path.dirname(full_file), exist_ok=True)
+        tmp_file = "{}.{}.tmp".format(full_file, threading.get_ident())
+        with open(tmp_file, 'wb') as obj_out:
+            obj_out.write(data)
+        os.replace(tmp_file, full_file)
+
+    def exists(self):
+        return os.path.isfile(self._path())
+
+    def _check_exists(self):
+        # GCS answers a missing object with a 404, which the helpers treat as permanent:
+        if not self.exists():
+            from google.cloud import exceptions
+            raise exceptions.NotFound("No such object: {}/{}".format(self.bucket_name, self.name))
+
+    @property
+    def size(self):
+        return os.path.getsize(self._path()) if self.exists() else None
+
+    @property
+    def md5_hash(self):
+        if not self.exists():
+            return None
+        with open(self._path(), 'rb') as obj_in:
+            return base64.b64encode(hashlib.md5(obj_in.read()).digest()).decode('ascii')
+
+    def reload(self):
+        self._client.throttle("reload")
+        self._check_exists()
+
+    def download_to_filename(self, filename):
+        self._client.throttle("download_to_filename")
+        self._check_exists()
+        with open(self._path(), 'rb') as obj_in, open(filename, 'wb') as local_out:
+            while True:
+                chunk = obj_in.read(1024 * 1024)
+                if not chunk:
+                    break
+                local_out.write(chunk)
+
+    def download_as_bytes(self, start=None, end=None):
+        self._client.throttle("download_as_bytes")
+        self._check_exists()
+        with open(self._path(), 'rb') as obj_in:
+            obj_in.seek(start or 0)
+            return obj_in.read(-1 if end is None else end - (start or 0) + 1)
+
+    def upload_from_filename(self, filename):
+        self._client.throttle("upload_from_filename")
+        with open(filename, 'rb') as local_in:
+            self._write(local_in.read())
+
+    def upload_from_file(self, file_obj, size=None):
+        self._client.throttle("upload_from_file")
+        self._write(file_obj.read() if size is None else file_obj.read(size))
+
+    def upload_from_string(self, data):
+        self._client.throttle("upload_from_string")
+        self._write(data if isinstance(data, bytes) else data.encode('utf-8'))
+
+    def compose(self, sources):
+        if len(sources) > 32:
+            raise ValueError("compose takes at most 32 sources, got {}".format(len(sources)))
+        self._client.throttle("compose")
+        pieces = []
+        for source in sources:
+            source._check_exists()
+            with open(source._path(), 'rb') as obj_in:
+                pieces.append(obj_in.read())
+        self._write(b''.join(pieces))
+
+    def delete(self):
+        self._check_exists()
+        os.remove(self._path())
+
+
+class _FakeDatasetRef(object):
+    def __init__(self, project, dataset_id):
+        self.project = project
+        self.dataset_id = dataset_id
+
+    def table(self, table_id):
+        return _FakeTableRef(self.project, self.dataset_id, table_id)
+
+
+class _FakeTableRef(object):
+    def __init__(self, project, dataset_id, table_id):
+        self.project = project
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+
+    def to_api_repr(self):
+        # Lets a job config take this as its destination
+        return {'projectId': self.project, 'datasetId': self.dataset_id, 'tableId': self.table_id}
+
+    def __str__(self):
+        return "{}.{}.{}".format(self.project, self.dataset_id, self.table_id)
+
+
+class FakeTable(object):
+    """
+    A table held by FakeBigQueryClient: schema, description, and the TSV lines that were loaded into it
+    """
+    def __init__(self, ref):
+        self.reference = ref
+        self.schema = []
+        self.description = None
+        self.header = None
+        self.lines = []
+
+    @property
+    def num_rows(self):
+        return len(self.lines)
+
+
+class FakeJob(object):
+    """
+    A BigQuery job that reports RUNNING until latency seconds after it was created, then DONE
+    """
+    _ids = itertools.count()
+
+    def __init__(self, job_type, latency, error=None, bytes_processed=0):
+        self.job_id = "fake_{}_{}".format(job_type, next(FakeJob._ids))
+        self.job_type = job_type
+        self._created = time.time()
+        self._latency = latency
+        self._error = error
+        self.total_bytes_processed = bytes_processed
+        self.input_file_bytes = bytes_processed
+        self.slot_millis = int(latency * 1000) if job_type == 'query' else None
+
+    @property
+    def state(self):
+        return 'DONE' if time.time() - self._created >= self._latency else 'RUNNING'
+
+    @property
+    def error_result(self):
+        return self._error if self.state == 'DONE' else None
+
+    @property
+    def errors(self):
+        return [self._error] if self.state == 'DONE' and self._error is not None else None
+
+    @property
+    def started(self):
+        return None
+
+    @property
+    def ended(self):
+        return None
+
+
+class FakeBigQueryClient(object):
+    """
+    BigQuery job simulator. Query, load and extract jobs take job_latency seconds to reach DONE, and
+    fail (with an error_result, as real jobs do) at fail_rate. Loads read TSVs out of the given
+    DirectoryStorageClient into in-memory tables, and extracts write them back out, wildcard URIs
+    and GZIP compression included. Table metadata calls wait api_latency seconds.
+    """
+    def __init__(self, storage_client=None, job_latency=0.5, api_latency=0.0, fail_rate=0.0, project='fake-project',
+                 seed=None):
+        self.project = project
+        self._storage = storage_client
+        self._job_latency = job_latency
+        self._api = _Throttle(api_latency, 0.0)
+        self._fail_rate = fail_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.tables = {}
+        self.jobs = {}
+
+    def __str__(self):
+        return "FakeBigQueryClient"
+
+    def dataset(self, dataset_id, project=None):
+        return _FakeDatasetRef(self.project if project is None else project, dataset_id)
+
+    def _key(self, table_ref):
+        """
+        Tables are keyed on dataset.table; table_ref can be a string, a fake or a real TableReference
+        """
+        if isinstance(table_ref, str):
+            pieces = table_ref.split('.')
+            return "{}.{}".format(pieces[-2], pieces[-1])
+        return "{}.{}".format(table_ref.dataset_id, table_ref.table_id)
+
+    def _new_job(self, job_type, bytes_processed):
+        with self._lock:
+            failed = self._random.random() < self._fail_rate
+        error = {'reason': 'backendError', 'message': 'injected job failure'} if failed else None
+        job = FakeJob(job_type, self._job_latency, error, bytes_processed)
+        with self._lock:
+            self.jobs[job.job_id] = job
+        return job, failed
+
+    def get_job(self, job_id, location=None):
+        self._api("get_job")
+        return self.jobs[job_id]
+
+    def get_table(self, table_ref):
+        self._api("get_table")
+        key = self._key(table_ref)
+        with self._lock:
+            table = self.tables.get(key)
+        if table is None:
+            from google.cloud import exceptions
+            raise exceptions.NotFound("Not found: Table {}".format(key))
+        return table
+
+    def update_table(self, table, fields):
+        self._api("update_table")
+        return table
+
+    def delete_table(self, table_ref):
+        self._api("delete_table")
+        key = self._key(table_ref)
+        with self._lock:
+            if self.tables.pop(key, None) is None:
+                from google.cloud import exceptions
+                raise exceptions.NotFound("Not found: Table {}".format(key))
+
+    def create_table(self, table_ref, schema=None):
+        """
+        Not in the real client with this signature; used to set up tables for a run
+        """
+        table = FakeTable(table_ref)
+        table.schema = list(schema or [])
+        with self._lock:
+            self.tables[self._key(table_ref)] = table
+        return table
+
+    def query(self, sql, location=None, job_config=None):
+        job, failed = self._new_job('query', len(sql))
+        destination = None if job_config is None else getattr(job_config, 'destination', None)
+        if destination is not None and not failed:
+            self.create_table(destination)
+        return job
+
+    def load_table_from_uri(self, source_uri, table_ref, location=None, job_config=None):
+        uris = [source_uri] if isinstance(source_uri, str) else list(source_uri)
+        lines = []
+        header = None
+        read_bytes = 0
+        skip_rows = 0 if job_config is None else (getattr(job_config, 'skip_leading_rows', 0) or 0)
+        for uri in uris:
+            data = self._read_uri(uri)
+            read_bytes += len(data)
+            file_lines = data.decode('utf-8').splitlines(True)
+            if skip_rows and file_lines:
+                header = file_lines[0]
+            lines.extend(file_lines[skip_rows:])
+        job, failed = self._new_job('load', read_bytes)
+        if not failed:
+            table = self.create_table(table_ref, None if job_config is None else getattr(job_config, 'schema', None))
+            table.header = header
+            table.lines = lines
+        return job
+
+    def extract_table(self, table_ref, destination_uri, location=None, job_config=None):
+        table = self.get_table(table_ref)
+        print_header = True if job_config is None else getattr(job_config, 'print_header', True)
+        compression = None if job_config is None else getattr(job_config, 'compression', None)
+        job, failed = self._new_job('extract', sum(len(line) for line in table.lines))
+        if failed:
+            return job
+        bucket_name, blob_name = self._split_uri(destination_uri)
+        if '*' in blob_name:
+            shard_rows = max(1, len(table.lines) // 4)
+            chunks = [table.lines[pos:pos + shard_rows] for pos in range(0, len(table.lines), shard_rows)] or [[]]
+            names = [blob_name.replace('*', '{:012d}'.format(i)) for i in range(len(chunks))]
+        else:
+            chunks = [table.lines]
+            names = [blob_name]
+        for name, chunk in zip(names, chunks):
+            data = ''.join(([table.header] if print_header and table.header else []) + chunk).encode('utf-8')
+            if compression is not None and str(compression).upper().endswith('GZIP'):
+                import gzip
+                data = gzip.compress(data)
+            self._storage.put(bucket_name, name, data)
+        return job
+
+    @staticmethod
+    def _split_uri(uri):
+        pieces = up.urlparse(uri)
+        return pieces.netloc, pieces.path[1:]
+
+    def _read_uri(self, uri):
+        bucket_name, blob_name = self._split_uri(uri)
+        if '*' in blob_name:
+            pattern = re.compile(re.escape(blob_name).replace('\\*', '.*') + '$')
+            blobs = [blob for blob in self._storage.list_blobs(bucket_name, prefix=blob_name.split('*')[0])
+                     if pattern.match(blob.name)]
+        else:
+            blobs = [self._storage.bucket(bucket_name).blob(blob_name)]
+        data = []
+        for blob in blobs:
+            with open(blob._path(), 'rb') as obj_in:
+                data.append(obj_in.read())
+        return b''.join(data)
+
+
+class _GDCStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def _send(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        stub = self.server.stub
+        try:
+            stub.throttle("GET")
+        except IOError:
+            self._send(503, b'')
+            return
+        pieces = up.urlparse(self.path)
+        query = {key: vals[0] for key, vals in up.parse_qs(pieces.query).items()}
+        if pieces.path.startswith('/index/'):
+            self._send(200, stub.indexd_body(query, pieces.path).encode('utf-8'), 'application/json')
+        elif pieces.path.startswith('/files'):
+            body, content_type = stub.files_body(query)
+            self._send(200, body.encode('utf-8'), content_type)
+        else:
+            self._send(404, b'')
+
+
+class GDCStubServer(object):
+    """
+    Local HTTP server for the GDC files endpoint (manifest and size=0 JSON queries, with from/size
+    paging) and IndexD bulk lookups (<indexd_url><id>,<id>,...). Serves the records it is given: dicts
+    with id, filename, md5, size, state and gs_url. Each request waits latency seconds, and gets a 503
+    at fail_rate. Filters are ignored: every query sees all the records.
+    """
+    MANIFEST_HEADER = "id\tfilename\tmd5\tsize\tstate\n"
+
+    def __init__(self, records, latency=0.0, fail_rate=0.0, seed=None):
+        self.records = sorted(records, key=lambda rec: rec['id'])
+        self._by_id = {rec['id']: rec for rec in records}
+        self.throttle = _Throttle(latency, fail_rate, seed)
+        self._server = None
+        self._thread = None
+
+    def __str__(self):
+        return "GDCStubServer"
+
+    def start(self):
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _GDCStubHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+        return False
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+    @property
+    def files_url(self):
+        return "{}/files".format(self.base_url)
+
+    @property
+    def indexd_url(self):
+        return "{}/index/index?ids=".format(self.base_url)
+
+    def files_body(self, query):
+        if query.get('format') == 'json':
+            body = json_dumps({'data': {'hits': [], 'pagination': {'total': len(self.records)}}})
+            return body, 'application/json'
+        start = int(query.get('from', 0))
+        size = int(query.get('size', 10))
+        rows = ["{}\t{}\t{}\t{}\t{}\n".format(rec['id'], rec['filename'], rec['md5'], rec['size'], rec['state'])
+                for rec in self.records[start:start + size]]
+        return self.MANIFEST_HEADER + ''.join(rows), 'text/plain'
+
+    def indexd_body(self, query, path):
+        ids = query['ids'] if 'ids' in query else path.rsplit('/', 1)[-1]
+        records = []
+        for file_id in ids.split(','):
+            rec = self._by_id[file_id]
+            records.append({'did': rec['id'], 'hashes': {'md5': rec['md5']}, 'size': rec['size'],
+                            'urls': ['https://api.gdc.cancer.gov/data/{}'.format(rec['id']), rec['gs_url']]})
+        return json_dumps({'records': records})
+
+
+def write_manifest(records, manifest_file):
+    """
+    Write records (as served by GDCStubServer) out in GDC manifest format
+    """
+    with open(manifest_file, 'w') as manifest_out:
+        manifest_out.write(GDCStubServer.MANIFEST_HEADER)
+        for rec in records:
+            manifest_out.write("{}\t{}\t{}\t{}\t{}\n".format(rec['id'], rec['filename'], rec['md5'], rec['size'],
+                                                              rec['state']))
+    return
+
+
+def stock_object_store(storage_client, bucket_name, files):
+    """
+    Put (file name, bytes) pairs into the store the way GDC lays out its buckets (<uuid>/<file name>).
+    Returns the GDCStubServer records for them.
+    """
+    records = []
+    for file_name, data in files:
+        file_id = "{:08x}-0000-4000-8000-{:012x}".format(len(records), int(hashlib.md5(data).hexdigest()[:12], 16))
+        gs_url = storage_client.put(bucket_name, "{}/{}".format(file_id, file_name), data)
+        records.append({'id': file_id, 'filename': file_name, 'md5': hashlib.md5(data).hexdigest(),
+                        'size': len(data), 'state': 'released', 'gs_url': gs_url})
+    return records
@@ -16,21 +16,208 @@ limitations under the License.
 
 """
 
-from google.cloud import bigquery
-from google.cloud import storage
-from google.cloud import exceptions
 import shutil
 import os
-import requests
 import copy
 import urllib.parse as up
 import time
-import zipfile
-import gzip
+import importlib
 import threading
+import queue
+import sqlite3
+import collections
+import hashlib
+import base64
+try:
+    import fcntl
+except ImportError:
+    pass
+import tempfile
+import pickle
+import heapq
+import itertools
+import io
+import re
+import sys
+import concurrent.futures
 from json import loads as json_loads, dumps as json_dumps
 
 
+class _LazyModule(object):
+    """
+    Module stand-in that does the real import the first time an attribute is used. The cloud SDKs
+    (and requests, which pulls in urllib3 and friends) take most of a second to import, which every
+    short-lived worker and kernel restart paid even when only the local file helpers were used.
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __str__(self):
+        return "_LazyModule"
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+
+bigquery = _LazyModule('google.cloud.bigquery')
+storage = _LazyModule('google.cloud.storage')
+exceptions = _LazyModule('google.cloud.exceptions')
+requests = _LazyModule('requests')
+zipfile = _LazyModule('zipfile')
+gzip = _LazyModule('gzip')
+
+_FAST_GZIP = []
+
+
+def _gzip_module():
+    """
+    The ISA-L gzip backend (python-isal) if it is installed, else the standard gzip module. Looked
+    up on first use, like the modules above.
+    """
+    if not _FAST_GZIP:
+        try:
+            _FAST_GZIP.append(importlib.import_module('isal.igzip'))
+        except ImportError:
+            _FAST_GZIP.append(gzip)
+    return _FAST_GZIP[0]
+
+#
+# The storage and BigQuery clients used by all the helpers below come from one process-wide ClientPool.
+# set_backends() can swap in stand-ins (e.g. the ones in fake_backends.py) to run the pipeline offline:
+#
+
+_BACKENDS = {'storage': None, 'bigquery': None}
+
+
+class ClientPool(object):
+    """
+    Process-wide registry of storage and BigQuery clients. Each client is built on first use and then
+    shared, keyed by (kind, project, location), so credentials are resolved and an HTTP transport is set
+    up once instead of on every helper call. The transports get connection pools of pool_size; threaded
+    callers such as BucketPuller raise that with ensure_pool_size() to match their thread count. Safe to
+    use from many threads. A forked child process starts with an empty pool, since HTTP connections
+    can't be shared across a fork.
+    One client (so one requests.Session) serving many threads is how the Google clients are meant to be
+    used: each request checks a connection out of the adapter's urllib3 pool, which is thread-safe, and
+    google-auth refreshes the token under its own lock. With pool_size at least the number of threads,
+    no thread waits on a connection or opens one that then gets discarded. So call ensure_pool_size()
+    before getting the client the threads will use. Growing the pool never touches a session that may
+    be in use (mounting adapters on it would race with other threads' requests): the clients built so
+    far are just dropped from the registry, so anyone holding one keeps it as it is, and the next get()
+    builds a new client with the bigger pool.
+    """
+    def __init__(self, pool_size=10):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = os.getpid()
+        self.pool_size = pool_size
+        self.created = 0
+
+    def __str__(self):
+        return "ClientPool"
+
+    def get(self, kind, project=None, location=None):
+        """
+        The shared client for kind ('storage' or 'bigquery'), project and location (BigQuery only)
+        """
+        key = (kind, project, location)
+        if self._pid == os.getpid():
+            client = self._clients.get(key)
+            if client is not None:
+                return client
+        with self._lock:
+            if self._pid != os.getpid():
+                self._clients = {}
+                self._pid = os.getpid()
+            client = self._clients.get(key)
+            if client is None:
+                client = self._create(kind, project, location)
+                self._tune(client, self.pool_size)
+                self._clients[key] = client
+                self.created += 1
+            return client
+
+    def ensure_pool_size(self, pool_size):
+        """
+        Make sure every client handed out from now on can hold at least pool_size open connections
+        """
+        with self._lock:
+            if pool_size <= self.pool_size:
+                return
+            self.pool_size = pool_size
+            self._clients = {}
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+
+    @staticmethod
+    def _create(kind, project, location):
+        factory = _BACKENDS[kind]
+        if factory is not None:
+            return factory()
+        if kind == 'storage':
+            # storage.Client(project=None) means "no project", not "the default project":
+            return storage.Client() if project is None else storage.Client(project=project)
+        return bigquery.Client(project=project, location=location)
+
+    @staticmethod
+    def _tune(client, pool_size):
+        # The Google clients talk through client._http, a requests.Session:
+        session = getattr(client, '_http', None)
+        if session is None or not hasattr(session, 'mount'):
+            return
+        # Only called on a client nobody else has yet, so swapping its adapters is safe:
+        replaced = []
+        for prefix in ('https://', 'http://'):
+            old_adapter = session.adapters.get(prefix)
+            if old_adapter is not None and type(old_adapter) is not requests.adapters.HTTPAdapter:
+                continue  # e.g. google-auth's mutual TLS adapter, which we can't rebuild
+            kwargs = {}
+            if old_adapter is not None:
+                kwargs['max_retries'] = old_adapter.max_retries
+                kwargs['pool_block'] = getattr(old_adapter, '_pool_block', requests.adapters.DEFAULT_POOLBLOCK)
+                if old_adapter not in replaced:
+                    replaced.append(old_adapter)
+            session.mount(prefix, requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                                                **kwargs))
+        for old_adapter in replaced:
+            old_adapter.close()
+
+
+client_pool = ClientPool()
+
+
+def set_backends(storage_factory=None, bigquery_factory=None):
+    """
+    Have the helpers get their clients from storage_factory() and bigquery_factory() instead of
+    storage.Client() and bigquery.Client(). A None factory restores the Google client.
+    """
+    _BACKENDS['storage'] = storage_factory
+    _BACKENDS['bigquery'] = bigquery_factory
+    client_pool.clear()
+    return
+
+
+def _storage_client(project=None):
+    return client_pool.get('storage', project)
+
+
+def _bq_client(project=None, location=None):
+    return client_pool.get('bigquery', project, location)
+
+
 def checkToken(aToken):
     """
     Used by pickColumns, below:
@@ -92,6 +279,59 @@ def pickColumns(tokenList):
 
     return newList
 
+def _merged_maf_line(aPrint, calls, hdrPick, mutCallers, do_logging, log_file):
+    """
+    Build the merged output line (sans newline) for one mutPrint from the list of caller results. Shared by
+    write_MAFs and merge_MAFs_external so both produce identical rows.
+    The calls are handled as a small matrix: each column is checked for agreement in one pass, and the
+    caller-ordered row list used for columns that disagree is worked out once per mutPrint.
+    """
+    if do_logging: log_file.write(" ")
+    if do_logging: log_file.write(" looping over mutPrints ... {}\n".format(str(aPrint)))
+    numCalls = len(calls)
+    if do_logging: log_file.write("     numCalls = {}\n".format(numCalls))
+    if (numCalls == 0):
+        return ''
+    if do_logging: log_file.write("     # of features = {}\n".format(len(calls[0])))
+    if do_logging: log_file.write("{}\n".format(str(calls[0])))
+
+    ## With only one caller, every feature is just written out:
+    if (numCalls == 1):
+        return '\t'.join([str(tok) for tok in calls[0]])
+
+    ## Rows to emit, in the order of the callers, for features where the callers disagree.
+    ## 3rd from the last feature is the 'caller':
+    caller_rows = {}
+    for ii in range(numCalls):
+        caller_rows.setdefault(calls[ii][-3], []).append(ii)
+    caller_order = [ii for c in mutCallers for ii in caller_rows.get(c, [])]
+
+    fields = []
+    for kk, v in enumerate(zip(*calls)):
+        ## if all the callers came up with the same output, then just write that
+        if (v.count(v[0]) == numCalls):
+            fields.append(str(v[0]))
+            continue
+
+        if do_logging:
+            u = list(dict.fromkeys(v))
+            log_file.write("{} {} {} {}\n".format(str(kk), str(hdrPick[kk]), len(u), str(list(v))))
+            log_file.write(" looping over {}\n".format(mutCallers))
+            log_file.write("{}\n".format(str(u)))
+            log_file.write("{}\n".format(str(list(v))))
+            for ii in caller_order:
+                log_file.write("         found ! {}\n".format(str(calls[ii][-3])))
+
+        ## otherwise we need to write out the the values in the order of the callers ...
+        if caller_order:
+            fields.append('|'.join([str(v[ii]) for ii in caller_order]))
+        elif not fields:
+            ## Legacy quirk: with no known caller, the field is dropped, unless it is the first one,
+            ## which comes out blank.
+            fields.append('')
+    return '\t'.join(fields)
+
+
 def write_MAFs(tumor, mutCalls, hdrPick, mutCallers, do_logging):
     """
     Sheila's function to write out MAFs for merging
@@ -114,158 +354,509 @@ def write_MAFs(tumor, mutCalls, hdrPick, mutCallers, do_logging):
             log_file.write(" --> total # of mutPrints : {}\n".format(len(mutPrints)))
 
             for aPrint in mutPrints:
-
-                if do_logging: log_file.write(" ")
-                if do_logging: log_file.write(" looping over mutPrints ... {}\n".format(str(aPrint)))
                 numCalls = len(mutCalls[aPrint])
-                if do_logging: log_file.write("     numCalls = {}\n".format(numCalls))
                 histCount[numCalls] += 1
-                outLine = ''
+                outLine = _merged_maf_line(aPrint, mutCalls[aPrint], hdrPick, mutCallers, do_logging, log_file)
                 if (numCalls > 0):
-                    if do_logging: log_file.write("     # of features = {}\n".format(len(mutCalls[aPrint][0])))
-                    if do_logging: log_file.write("{}\n".format(str(mutCalls[aPrint][0])))
-
-                    ## for each feature we want to see if the different callers
-                    ## came up with different outputs ... so we create a vector
-                    ## of all of the outputs [v], and a vector of only the unique
-                    ## outputs [u]
-                    for kk in range(len(mutCalls[aPrint][0])):
-                        u = []
-                        v = []
-                        for ii in range(len(mutCalls[aPrint])):
-                            if (mutCalls[aPrint][ii][kk] not in u):
-                                u += [mutCalls[aPrint][ii][kk]]
-                            v += [mutCalls[aPrint][ii][kk]]
-                        if (len(u) > 1):
-                            if do_logging: log_file.write(
-                                "{} {} {} {}\n".format(str(kk), str(hdrPick[kk]), len(u), str(v)))
-
-                        ## if we have nothing, then it's a blank field
-                        if (len(v) == 0):
-                            outLine += "\t"
-
-                        ## if we only have one value, then just write that
-                        elif (len(u) == 1 or len(v) == 1):
-                            outLine += "%s\t" % v[0]
-
-                        ## otherwise we need to write out the the values in the
-                        ## order of the callers ...
-                        else:
-                            if do_logging: log_file.write(" looping over {}\n".format(mutCallers))
-                            if do_logging: log_file.write("{}\n".format(str(u)))
-                            if do_logging: log_file.write("{}\n".format(str(v)))
-                            for c in mutCallers:
-                                for ii in range(len(mutCalls[aPrint])):
-                                    ## 3rd from the last feature is the 'caller'
-                                    if (mutCalls[aPrint][ii][-3] == c):
-                                        if do_logging: log_file.write("         found ! {}\n".format(str(c)))
-                                        outLine += "%s|" % v[ii]
-                            outLine = outLine[:-1] + "\t"
-                    fhOut.write("%s\n" % outLine[:-1])
+                    fhOut.write("%s\n" % outLine)
 
     return histCount
 
 
+class PipelineMetrics(object):
+    """
+    Counters and timers for the pipeline stages (bucket pulls, concatenation, MAF reads, uploads, BQ
+    jobs). Each stage has files/rows/bytes counters (plus any others a caller adds), wall and CPU time
+    (CPU of this process only, so process pool workers are not counted), and a history of the last
+    window seconds for a rolling throughput and ETA. Renderers such as ProgressBarRenderer get a
+    snapshot as counts come in. dump_trace() writes out every stage and recorded event as JSON.
+    One instance can be shared by all the threads and helpers of a run.
+    """
+    def __init__(self, run_name=None, renderers=None, window=30.0):
+        self._lock = threading.Lock()
+        self.run_name = run_name
+        self._renderers = [] if renderers is None else list(renderers)
+        self._window = window
+        self._stages = collections.OrderedDict()
+        self._events = []
+        self._start = time.time()
+
+    def __str__(self):
+        return "PipelineMetrics"
+
+    def start_stage(self, name, total=None):
+        """
+        Start timing a stage; total (in files) is used for the ETA. A name already used in this run
+        gets a #2, #3, ... suffix. Returns the stage name to pass to add() and end_stage().
+        """
+        with self._lock:
+            use_name = name
+            count = 1
+            while use_name in self._stages:
+                count += 1
+                use_name = "{}#{}".format(name, count)
+            now = time.time()
+            self._stages[use_name] = {
+                'total': total,
+                'counters': collections.Counter(),
+                'start': now,
+                'cpu_start': time.process_time(),
+                'end': None,
+                'cpu': None,
+                'history': collections.deque([(now, 0, 0, 0)])
+            }
+        return use_name
+
+    def add(self, name, files=0, rows=0, num_bytes=0, **others):
+        """
+        Bump the counters of a running stage
+        """
+        with self._lock:
+            stage = self._stages[name]
+            counters = stage['counters']
+            counters['files'] += files
+            counters['rows'] += rows
+            counters['bytes'] += num_bytes
+            counters.update(others)
+            now = time.time()
+            history = stage['history']
+            history.append((now, counters['files'], counters['rows'], counters['bytes']))
+            # Keep one point older than the window as the baseline for the rolling rates:
+            while len(history) > 2 and history[1][0] < now - self._window:
+                history.popleft()
+            if self._renderers:
+                snap = self._snapshot(name)
+                for renderer in self._renderers:
+                    renderer.update(name, snap)
+
+    def end_stage(self, name):
+        with self._lock:
+            stage = self._stages[name]
+            stage['end'] = time.time()
+            stage['cpu'] = time.process_time() - stage['cpu_start']
+            if self._renderers:
+                snap = self._snapshot(name)
+                for renderer in self._renderers:
+                    renderer.finish(name, snap)
+
+    def record_event(self, name, event):
+        """
+        Add an event (a JSON-able dict, e.g. a BQ job status) to the trace, tagged with the stage
+        """
+        with self._lock:
+            trace_event = {'stage': name, 'time': time.time() - self._start}
+            trace_event.update(event)
+            self._events.append(trace_event)
+
+    def snapshot(self, name):
+        with self._lock:
+            return self._snapshot(name)
+
+    def _snapshot(self, name):
+        stage = self._stages[name]
+        counters = stage['counters']
+        now = time.time() if stage['end'] is None else stage['end']
+        wall = now - stage['start']
+        cpu = time.process_time() - stage['cpu_start'] if stage['cpu'] is None else stage['cpu']
+        first, last = stage['history'][0], stage['history'][-1]
+        span = last[0] - first[0]
+        if span > 0:
+            rates = [(last[i] - first[i]) / span for i in (1, 2, 3)]
+        else:
+            rates = [0.0, 0.0, 0.0]
+        eta = None
+        if stage['total'] is not None and stage['end'] is None and rates[0] > 0:
+            eta = max(stage['total'] - counters['files'], 0) / rates[0]
+        return {
+            'total': stage['total'],
+            'counters': dict(counters),
+            'wall': wall,
+            'cpu': cpu,
+            'files_per_sec': rates[0],
+            'rows_per_sec': rates[1],
+            'bytes_per_sec': rates[2],
+            'eta': eta,
+            'done': stage['end'] is not None
+        }
+
+    def report(self):
+        """
+        Print one line per stage: counts, wall and CPU time, and average throughput
+        """
+        with self._lock:
+            names = list(self._stages.keys())
+        for name in names:
+            snap = self.snapshot(name)
+            counters = snap['counters']
+            secs = max(snap['wall'], 1e-6)
+            extras = ''.join(", {} {}".format(val, key) for key, val in sorted(counters.items())
+                             if key not in ('files', 'rows', 'bytes'))
+            print("{}: {} files, {} rows, {:.1f} MB{} in {:.1f} s wall, {:.1f} s CPU, {:.1f} MB/s".format(
+                name, counters.get('files', 0), counters.get('rows', 0), counters.get('bytes', 0) / 1e6, extras,
+                snap['wall'], snap['cpu'], counters.get('bytes', 0) / secs / 1e6))
+
+    def dump_trace(self, trace_file):
+        """
+        Write the run (every stage snapshot, plus the recorded events) to trace_file as JSON
+        """
+        with self._lock:
+            trace = {
+                'run_name': self.run_name,
+                'started': self._start,
+                'wall': time.time() - self._start,
+                'stages': collections.OrderedDict((name, self._snapshot(name)) for name in self._stages),
+                'events': list(self._events)
+            }
+        tmp_file = "{}.tmp".format(trace_file)
+        with open(tmp_file, 'w') as trace_out:
+            trace_out.write(json_dumps(trace, indent=2, default=str))
+        os.replace(tmp_file, trace_file)
+        return
+
+
+class ProgressBarRenderer(object):
+    """
+    PipelineMetrics renderer that draws the print_progress_bar bar for stages with a total, redrawn
+    every 1/steps of the way, with the rolling rate and ETA as the suffix.
+    """
+    def __init__(self, steps=100, length=100):
+        self._steps = steps
+        self._length = length
+        self._last_step = {}
+
+    def __str__(self):
+        return "ProgressBarRenderer"
+
+    def _draw(self, name, snap):
+        done = snap['counters'].get('files', 0)
+        suffix = "{:.1f} MB/s".format(snap['bytes_per_sec'] / 1e6)
+        if snap['eta'] is not None:
+            suffix += " ETA {:.0f} s".format(snap['eta'])
+        print_progress_bar(done, snap['total'], prefix=name, suffix=suffix, length=self._length)
+
+    def update(self, name, snap):
+        if not snap['total']:
+            return
+        step = snap['counters'].get('files', 0) * self._steps // snap['total']
+        if step != self._last_step.get(name):
+            self._last_step[name] = step
+            self._draw(name, snap)
+
+    def finish(self, name, snap):
+        # Draw the final state, unless update() already drew the full bar:
+        if snap['total'] and self._last_step.get(name) != self._steps:
+            self._draw(name, snap)
+
+
+class TextLineSource(object):
+    """
+    Read lines from a plain, .gz or .zip file, decompressing on the fly instead of inflating a copy to
+    disk. A .zip is expected to hold a member named for the archive minus the .zip suffix. Uses the
+    ISA-L gzip backend (python-isal) when it is installed. Entering returns a text handle, or None if
+    the file (or zip member) is not there. After the with block, rate_message() reports bytes/sec.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._zip = None
+        self._handle = None
+        self._start = None
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return "TextLineSource"
+
+    def __enter__(self):
+        self._start = time.time()
+        if self._filename.endswith('.zip'):
+            self._zip = zipfile.ZipFile(self._filename, "r")
+            member = os.path.basename(self._filename)[:-4]
+            if member not in self._zip.namelist():
+                return None
+            raw = self._zip.open(member)
+        elif self._filename.endswith('.gz'):
+            raw = _gzip_module().open(self._filename, "rb")
+        elif os.path.isfile(self._filename):
+            raw = open(self._filename, "rb")
+        else:
+            return None
+        self.compressed_bytes = os.path.getsize(self._filename)
+        self._handle = io.TextIOWrapper(raw)
+        return self._handle
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._handle is not None:
+            try:
+                self.uncompressed_bytes = self._handle.buffer.tell()
+            except (OSError, ValueError):
+                self.uncompressed_bytes = self.compressed_bytes
+            self._handle.close()
+        if self._zip is not None:
+            self._zip.close()
+        self.elapsed = time.time() - self._start
+        return False
+
+    def rate_message(self):
+        secs = max(self.elapsed, 1e-6)
+        return "read {}: {} bytes ({} uncompressed) in {:.2f} s, {:.1f} MB/s ({:.1f} MB/s uncompressed)".format(
+            self._filename, self.compressed_bytes, self.uncompressed_bytes, self.elapsed,
+            self.compressed_bytes / secs / 1e6, self.uncompressed_bytes / secs / 1e6)
+
+
+def _parse_MAF_file(aFile, file_info_list, extra_cols, col_count, do_logging, key_fields, first_token,
+                    hdrPick, log_file, add_call):
+    """
+    Parse one MAF file, handing each (mutPrint, infoList) to add_call. Used by all the MAF readers.
+    Returns the (possibly updated) hdrPick, and whether the file was found.
+    """
+    found = False
+    hdrTokenCount = None if hdrPick is None else len(hdrPick) - len(extra_cols)
+    if do_logging: log_file.write(" Next file is <%s> \n" % aFile)
+    log_file.write(" opening input file {}\n".format(aFile))
+    log_file.write(" fileInfo : {}\n".format(str(file_info_list)))
+
+    source = TextLineSource(aFile)
+    with source as fh:
+        if fh is None:
+            print('{} was not found'.format(aFile))
+            return hdrPick, found
+        found = True
+        key_indices = []
+        for aLine in fh:
+            if aLine.startswith("#"):
+                continue
+            if aLine.startswith(first_token):
+                aLine = aLine.strip()
+                hdrTokens = aLine.split('\t')
+                if len(hdrTokens) != col_count:
+                    print("ERROR: incorrect number of header tokens! {} vs {}".format(col_count,
+                                                                                      len(hdrTokens)))
+                    print(hdrTokens)
+                    raise Exception()
+                    ## We no longer prune or sort columns, so assignment is now direct:
+                hdrPick = copy.copy(hdrTokens)
+                hdrTokenCount = len(hdrTokens)
+                ## hdrPick = pickColumns ( hdrTokens )
+                ## since we're not skipping any columns, we should have 120 at this point
+                ## print " --> len(hdrPick) = ", len(hdrPick)
+                hdrPick += extra_cols
+                ## and 124 at this point ...
+                ## print " --> after adding a few more fields ... ", len(hdrPick)
+                for keef in key_fields:
+                    key_indices.append(hdrPick.index(keef))
+                continue
+
+            if hdrPick is None:
+                print("ERROR: Header row not found")
+                raise Exception()
+
+            aLine = aLine.strip()
+            tokenList = aLine.split('\t')
+            if len(tokenList) != hdrTokenCount:
+                print(
+                "ERROR: incorrect number of tokens! {} vs {}".format(len(tokenList), hdrTokenCount))
+                raise Exception()
+
+            # This creates a key for a dictionary for each mutation belonging to a tumor sample:
+
+            mpl = [tokenList[x] for x in key_indices]
+            mutPrint = tuple(mpl)
+            if do_logging: log_file.write("{}\n".format(str(mutPrint)))
+
+            ##infoList = pickColumns(tokenList) + file_info_list
+            ## Again, no longer pruning columns!
+            infoList = tokenList + file_info_list
+            if len(infoList) != len(hdrPick):
+                print(" ERROR: inconsistent number of tokens!")
+                raise Exception()
+
+            if do_logging: log_file.write(" --> infoList : {}\n".format(str(infoList)))
+            add_call(mutPrint, infoList)
+
+    log_file.write(" {}\n".format(source.rate_message()))
+    return hdrPick, found
+
+
+def _read_MAF_worker(aFile, file_info_list, extra_cols, col_count, do_logging, key_fields, first_token):
+    """
+    Process pool worker for read_MAFs: parse one file into a partial mutCalls map. Log output is
+    captured and handed back so the parent can write it out in file order.
+    """
+    partial = {}
+    log_file = io.StringIO()
+
+    def add_call(mutPrint, infoList):
+        if mutPrint not in partial:
+            partial[mutPrint] = []
+        partial[mutPrint] += [infoList]
+        if do_logging: log_file.write(
+            " --> len(mutCalls[mutPrint]) = {}\n".format(len(partial[mutPrint])))
+
+    hdrPick, found = _parse_MAF_file(aFile, file_info_list, extra_cols, col_count, do_logging,
+                                     key_fields, first_token, None, log_file, add_call)
+    return hdrPick, found, partial, log_file.getvalue()
+
+
+class MAFTokenInterner(object):
+    """
+    Compact record store support for read_MAFs. Keeps a dictionary per MAF column so that repeated
+    values (Center, caller, Variant_Classification, the program/tumor prefix, ...) are held once and
+    shared by every row, and turns each row into a tuple. Columns that turn out to be high-cardinality
+    (positions, barcodes, ...) stop being interned once they pass max_distinct values, since a dict entry
+    per value would cost more than it saves.
+    """
+    __slots__ = ('_columns', '_max_distinct')
+
+    def __init__(self, max_distinct=50000):
+        self._columns = []
+        self._max_distinct = max_distinct
+
+    def __str__(self):
+        return "MAFTokenInterner"
+
+    def intern_row(self, infoList):
+        columns = self._columns
+        while len(columns) < len(infoList):
+            columns.append({})
+        row = []
+        for kk, tok in enumerate(infoList):
+            col_dict = columns[kk]
+            if col_dict is not None:
+                tok = col_dict.setdefault(tok, tok)
+                if len(col_dict) > self._max_distinct:
+                    columns[kk] = None
+            row.append(tok)
+        return tuple(row)
+
+
+def mut_calls_memory_size(mutCalls):
+    """
+    Deep size in bytes of a mutCalls dict: the dict, its keys, the per-key lists, the rows and the
+    tokens. Objects shared between rows are only counted once.
+    """
+    seen = set()
+    total = 0
+    stack = [mutCalls]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return total
+
+
+def maf_memory_report(tumor_type, maf_list, program_prefix, extra_cols, col_count,
+                      key_fields, first_token, file_info_func):
+    """
+    Read the same MAFs both ways (plain lists, and compact interned tuples) and report the in-memory
+    size of each mutCalls representation. Returns (plain_bytes, compact_bytes).
+    """
+    mutCalls, _ = read_MAFs(tumor_type, maf_list, program_prefix, extra_cols, col_count,
+                            False, key_fields, first_token, file_info_func)
+    num_prints = len(mutCalls)
+    num_calls = sum(len(calls) for calls in mutCalls.values())
+    plain_bytes = mut_calls_memory_size(mutCalls)
+    del mutCalls
+    mutCalls, _ = read_MAFs(tumor_type, maf_list, program_prefix, extra_cols, col_count,
+                            False, key_fields, first_token, file_info_func, compact=True)
+    compact_bytes = mut_calls_memory_size(mutCalls)
+    del mutCalls
+
+    print("{}: {} mutPrints, {} calls".format(tumor_type, num_prints, num_calls))
+    print("   list representation:    {:,} bytes ({:.1f} per call)".format(plain_bytes,
+                                                                            plain_bytes / max(num_calls, 1)))
+    print("   compact representation: {:,} bytes ({:.1f} per call)".format(compact_bytes,
+                                                                            compact_bytes / max(num_calls, 1)))
+    print("   compact is {:.1f}% of list".format(100.0 * compact_bytes / max(plain_bytes, 1)))
+    return plain_bytes, compact_bytes
+
+
 def read_MAFs(tumor_type, maf_list, program_prefix, extra_cols, col_count,
-              do_logging, key_fields, first_token, file_info_func):
+              do_logging, key_fields, first_token, file_info_func, num_procs=1, compact=False, metrics=None):
     """
     Sheila's function to read MAFs for merging.
     Original MAF table merged identical results from the different callers. This is the function to read
     in results and build merged dictionaries.
+    If num_procs > 1, files are parsed in a process pool and the per-file maps are combined in maf_list
+    order, so the result (and thus write_MAFs output) is the same as the serial read. In that mode each
+    file must carry its own header line. file_info_func is still only called in this process. No more
+    than 2 * num_procs files are parsed ahead of the merge, so only that many per-file maps are held
+    at once.
+    If compact is True, each call is stored as a tuple whose repeated tokens are shared through a
+    MAFTokenInterner, which cuts memory use a lot for big cohorts. write_MAFs handles either form.
+    Files, calls (as rows) and file bytes read are counted in a "read_MAFs" stage of metrics, if given.
     """
     hdrPick = None
     mutCalls = {}
+    interner = MAFTokenInterner() if compact else None
+    metrics = PipelineMetrics() if metrics is None else metrics
+    call_count = [0]
     with open("MAFLOG-READ-{}.txt".format(tumor_type), 'w') as log_file:
 
+        def add_call(mutPrint, infoList):
+            call_count[0] += 1
+            # list for each key:
+            if mutPrint not in mutCalls:
+                mutCalls[mutPrint] = []
+            if interner is not None:
+                infoList = interner.intern_row(infoList)
+            mutCalls[mutPrint] += [infoList]
+            if do_logging: log_file.write(
+                " --> len(mutCalls[mutPrint]) = {}\n".format(len(mutCalls[mutPrint])))
+
+        use_files = []
         for aFile in maf_list:
             file_info_list = file_info_func(aFile, program_prefix)
             if file_info_list[0] != (program_prefix + tumor_type):
                 continue
-            try:
-                if do_logging: log_file.write(" Next file is <%s> \n" % aFile)
-                toss_zip = False
-                if aFile.endswith('.gz'):
-                    dir_name = os.path.dirname(aFile)
-                    use_file_name = aFile[:-3]
-                    log_file.write("Uncompressing {}\n".format(aFile))
-                    with gzip.open(aFile, "rb") as gzip_in:
-                        with open(use_file_name, "wb") as uncomp_out:
-                            shutil.copyfileobj(gzip_in, uncomp_out)
-                    toss_zip = True
-                else:
-                    use_file_name = aFile
-
-                log_file.write(" opening input file {}\n".format(use_file_name))
-                log_file.write(" fileInfo : {}\n".format(str(file_info_list)))
-
-                if os.path.isfile(use_file_name):
-                    with open(use_file_name, 'r') as fh:
-                        key_indices = []
-                        for aLine in fh:
-                            if aLine.startswith("#"):
-                                continue
-                            if aLine.startswith(first_token):
-                                aLine = aLine.strip()
-                                hdrTokens = aLine.split('\t')
-                                if len(hdrTokens) != col_count:
-                                    print("ERROR: incorrect number of header tokens! {} vs {}".format(col_count,
-                                                                                                      len(hdrTokens)))
-                                    print(hdrTokens)
-                                    raise Exception()
-                                    ## We no longer prune or sort columns, so assignment is now direct:
-                                hdrPick = copy.copy(hdrTokens)
-                                ## hdrPick = pickColumns ( hdrTokens )
-                                ## since we're not skipping any columns, we should have 120 at this point
-                                ## print " --> len(hdrPick) = ", len(hdrPick)
-                                hdrPick += extra_cols
-                                ## and 124 at this point ...
-                                ## print " --> after adding a few more fields ... ", len(hdrPick)
-                                for keef in key_fields:
-                                    key_indices.append(hdrPick.index(keef))
-                                continue
-
-                            if hdrPick is None:
-                                print("ERROR: Header row not found")
-                                raise Exception()
-
-                            aLine = aLine.strip()
-                            tokenList = aLine.split('\t')
-                            if len(tokenList) != len(hdrTokens):
-                                print(
-                                "ERROR: incorrect number of tokens! {} vs {}".format(len(tokenList), len(hdrTokens)))
-                                raise Exception()
-
-                            # This creates a key for a dictionary for each mutation belonging to a tumor sample:
-
-                            mpl = [tokenList[x] for x in key_indices]
-                            mutPrint = tuple(mpl)
-                            if do_logging: log_file.write("{}\n".format(str(mutPrint)))
-
-                            # list for each key:
-                            if mutPrint not in mutCalls:
-                                mutCalls[mutPrint] = []
-
-                            ##infoList = pickColumns(tokenList) + file_info_list
-                            ## Again, no longer pruning columns!
-                            infoList = tokenList + file_info_list
-                            if len(infoList) != len(hdrPick):
-                                print(" ERROR: inconsistent number of tokens!")
-                                raise Exception()
-
-                            if do_logging: log_file.write(" --> infoList : {}\n".format(str(infoList)))
-                            mutCalls[mutPrint] += [infoList]
-                            if do_logging: log_file.write(
-                                " --> len(mutCalls[mutPrint]) = {}\n".format(len(mutCalls[mutPrint])))
-
+            use_files.append((aFile, file_info_list))
+        stage = metrics.start_stage('read_MAFs', total=len(use_files))
+
+        if num_procs > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_procs) as executor:
+                in_flight = collections.deque()
+                next_file = 0
+                while next_file < len(use_files) or in_flight:
+                    while next_file < len(use_files) and len(in_flight) < 2 * num_procs:
+                        aFile, file_info_list = use_files[next_file]
+                        in_flight.append((aFile, executor.submit(_read_MAF_worker, aFile, file_info_list, extra_cols,
+                                                                 col_count, do_logging, key_fields, first_token)))
+                        next_file += 1
+                    aFile, future = in_flight.popleft()
+                    file_hdr, found, partial, log_text = future.result()
+                    log_file.write(log_text)
+                    if file_hdr is not None:
+                        hdrPick = file_hdr
+                    # Combining in file order keeps key order and caller order the same as a serial read:
+                    for mutPrint, calls in partial.items():
+                        if interner is not None:
+                            calls = [interner.intern_row(infoList) for infoList in calls]
+                        if mutPrint not in mutCalls:
+                            mutCalls[mutPrint] = calls
+                        else:
+                            mutCalls[mutPrint] += calls
+                        call_count[0] += len(calls)
+                    if found:
                         log_file.write(" --> done with this file ... {}\n".format(len(mutCalls)))
-                else:
-                    # If previous job died a nasty death, following finally statement may not get run, causing
-                    # file manifest to hold onto a previously unzipped file that gets deleted. Catch that
-                    # problem!
-                    print('{} was not found'.format(use_file_name))
-            finally:
-                if toss_zip and os.path.isfile(use_file_name):
-                    os.remove(use_file_name)
+                    metrics.add(stage, files=1, rows=call_count[0],
+                                num_bytes=os.path.getsize(aFile) if found else 0)
+                    call_count[0] = 0
+        else:
+            for aFile, file_info_list in use_files:
+                hdrPick, found = _parse_MAF_file(aFile, file_info_list, extra_cols, col_count, do_logging,
+                                                 key_fields, first_token, hdrPick, log_file, add_call)
+                if found:
+                    log_file.write(" --> done with this file ... {}\n".format(len(mutCalls)))
+                metrics.add(stage, files=1, rows=call_count[0], num_bytes=os.path.getsize(aFile) if found else 0)
+                call_count[0] = 0
+        metrics.end_stage(stage)
 
         log_file.write("\n")
         log_file.write(" DONE READING MAFs ... \n")
@@ -273,6 +864,180 @@ def read_MAFs(tumor_type, maf_list, program_prefix, extra_cols, col_count,
     return mutCalls, hdrPick
 
 
+def _spill_run(records, spill_dir, block_bytes, size_func):
+    """
+    Write a sorted run (a list or an iterator) out to a temp file as a series of pickled blocks of about
+    block_bytes each, as estimated by size_func. Returns the file name.
+    """
+    fd, run_file = tempfile.mkstemp(suffix='.run', dir=spill_dir)
+    with os.fdopen(fd, 'wb') as run_out:
+        block = []
+        block_size = 0
+        for record in records:
+            block.append(record)
+            block_size += size_func(record)
+            if block_size >= block_bytes:
+                pickle.dump(block, run_out, protocol=pickle.HIGHEST_PROTOCOL)
+                block = []
+                block_size = 0
+        if block:
+            pickle.dump(block, run_out, protocol=pickle.HIGHEST_PROTOCOL)
+    return run_file
+
+
+def _read_run(run_file):
+    """
+    Stream the records of a run written by _spill_run back in.
+    """
+    with open(run_file, 'rb') as run_in:
+        while True:
+            try:
+                block = pickle.load(run_in)
+            except EOFError:
+                return
+            for record in block:
+                yield record
+
+
+def _merge_runs(runs, spill_dir, max_fan_in, block_bytes, size_func):
+    """
+    Merge sorted runs max_fan_in at a time into bigger runs, deleting the inputs as we go, until no
+    more than max_fan_in are left. Returns the remaining run files, ready for the final heapq.merge.
+    """
+    runs = list(runs)
+    while len(runs) > max_fan_in:
+        group = runs[:max_fan_in]
+        runs = runs[max_fan_in:]
+        merged = heapq.merge(*[_read_run(run) for run in group])
+        runs.append(_spill_run(merged, spill_dir, block_bytes, size_func))
+        for run in group:
+            os.remove(run)
+    return runs
+
+
+def _estimate_call_bytes(infoList):
+    """
+    Rough in-memory footprint of one call: string payloads plus per-object overhead.
+    """
+    return 120 + sum(64 + len(tok) for tok in infoList)
+
+
+def _call_record_bytes(record):
+    # (mutPrint, seq, infoList) records of merge_MAFs_external pass 1
+    return _estimate_call_bytes(record[2])
+
+
+def _row_record_bytes(record):
+    # (seq, outLine) records of merge_MAFs_external pass 2
+    return 100 + len(record[1])
+
+
+def merge_MAFs_external(tumor_type, maf_list, program_prefix, extra_cols, col_count, do_logging,
+                        key_fields, first_token, file_info_func, mutCallers,
+                        max_run_bytes=256 * 1024 * 1024, spill_dir=None, max_fan_in=64):
+    """
+    Bounded-memory version of read_MAFs followed by write_MAFs. Instead of holding every call in one
+    mutCalls dict, calls are spilled to disk in runs sorted on key_fields, and the runs are k-way merged
+    to build each merged row. A second sort puts the rows back in first-seen order, so the resulting
+    mergeA.<tumor>.maf is byte-identical to write_MAFs output. max_run_bytes caps the (estimated) size of
+    each in-memory run. No more than max_fan_in runs are open at once: if there are more, they are first
+    merged max_fan_in at a time into bigger runs. Runs are read back in blocks of max_run_bytes /
+    max_fan_in, so the open runs together also hold about max_run_bytes, and peak memory stays around
+    twice max_run_bytes (the runs being merged plus the row run being built) however small it is set.
+    Runs go into a temp directory under spill_dir.
+    Returns histCount, hdrPick
+    """
+    hdrPick = None
+    histCount = [0] * 10
+    max_fan_in = max(max_fan_in, 2)
+    block_bytes = max(max_run_bytes // max_fan_in, 1)
+    run_dir = tempfile.mkdtemp(prefix="mafmerge-{}-".format(tumor_type), dir=spill_dir)
+    try:
+        #
+        # Pass 1: read the calls, spilling runs sorted on (mutPrint, arrival order):
+        #
+        call_runs = []
+        buffer = []
+        state = {'seq': 0, 'bytes': 0}
+        with open("MAFLOG-READ-{}.txt".format(tumor_type), 'w') as log_file:
+
+            def add_call(mutPrint, infoList):
+                buffer.append((mutPrint, state['seq'], infoList))
+                state['seq'] += 1
+                state['bytes'] += _estimate_call_bytes(infoList)
+                if state['bytes'] >= max_run_bytes:
+                    # seq is unique, so sorting never falls through to comparing the infoLists:
+                    buffer.sort()
+                    call_runs.append(_spill_run(buffer, run_dir, block_bytes, _call_record_bytes))
+                    buffer.clear()
+                    state['bytes'] = 0
+
+            for aFile in maf_list:
+                file_info_list = file_info_func(aFile, program_prefix)
+                if file_info_list[0] != (program_prefix + tumor_type):
+                    continue
+                hdrPick, found = _parse_MAF_file(aFile, file_info_list, extra_cols, col_count, do_logging,
+                                                 key_fields, first_token, hdrPick, log_file, add_call)
+                if found:
+                    log_file.write(" --> done with this file ... {} calls\n".format(state['seq']))
+
+            if buffer:
+                buffer.sort()
+                call_runs.append(_spill_run(buffer, run_dir, block_bytes, _call_record_bytes))
+                buffer.clear()
+            log_file.write(" --> spilled {} sorted runs\n".format(len(call_runs)))
+            log_file.write("\n")
+            log_file.write(" DONE READING MAFs ... \n")
+            log_file.write("\n")
+
+        #
+        # Pass 2: merge the runs, build one output row per mutPrint, and spill rows sorted on the
+        # arrival order of the first call for that mutPrint:
+        #
+        row_runs = []
+        num_prints = 0
+        with open("MAFLOG-WRITE-{}.txt".format(tumor_type), 'w') as log_file:
+            call_runs = _merge_runs(call_runs, run_dir, max_fan_in, block_bytes, _call_record_bytes)
+            merged = heapq.merge(*[_read_run(run) for run in call_runs])
+            row_bytes = 0
+            for aPrint, group in itertools.groupby(merged, key=lambda rec: rec[0]):
+                group = list(group)
+                calls = [rec[2] for rec in group]
+                numCalls = len(calls)
+                histCount[numCalls] += 1
+                num_prints += 1
+                outLine = _merged_maf_line(aPrint, calls, hdrPick, mutCallers, do_logging, log_file)
+                if (numCalls > 0):
+                    buffer.append((group[0][1], outLine))
+                    row_bytes += 100 + len(outLine)
+                    if row_bytes >= max_run_bytes:
+                        buffer.sort()
+                        row_runs.append(_spill_run(buffer, run_dir, block_bytes, _row_record_bytes))
+                        buffer.clear()
+                        row_bytes = 0
+            if buffer:
+                buffer.sort()
+                row_runs.append(_spill_run(buffer, run_dir, block_bytes, _row_record_bytes))
+                buffer.clear()
+            log_file.write(" --> total # of mutPrints : {}\n".format(num_prints))
+
+        for run in call_runs:
+            os.remove(run)
+
+        #
+        # Pass 3: merge the row runs back into first-seen order:
+        #
+        row_runs = _merge_runs(row_runs, run_dir, max_fan_in, block_bytes, _row_record_bytes)
+        with open("mergeA." + tumor_type + ".maf", 'w') as fhOut:
+            fhOut.write("%s\n" % '\t'.join(hdrPick))
+            for _, outLine in heapq.merge(*[_read_run(run) for run in row_runs]):
+                fhOut.write("%s\n" % outLine)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    return histCount, hdrPick
+
+
 def concat_all_merged_files(all_files, one_big_tsv):
     """
     Concatenate all Merged Files
@@ -300,6 +1065,67 @@ def concat_all_merged_files(all_files, one_big_tsv):
     return
 
 
+class ResolutionCache(object):
+    """
+    Persistent SQLite cache of GDC file id -> (md5, size, gs_url) resolutions, so that reruns and other
+    tumor types do not have to go back to IndexD for files we have already seen. Entries older than
+    ttl_seconds are ignored (and refreshed when resolved again). Keeps hit/miss counts for report().
+    Can be shared between threads (e.g. PipelineDAG steps); the connection is used under a lock.
+    """
+    def __init__(self, db_file, ttl_seconds=30 * 24 * 3600):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_file, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS resolved "
+            "(uuid TEXT PRIMARY KEY, md5 TEXT, size INTEGER, gs_url TEXT, fetched REAL)")
+        self._db.commit()
+        self._ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    def __str__(self):
+        return "ResolutionCache"
+
+    def get_many(self, uuids):
+        """
+        Returns a dict of uuid -> {'md5', 'size', 'gs_url'} for the uuids with a fresh entry
+        """
+        found = {}
+        oldest = time.time() - self._ttl_seconds
+        uuids = list(uuids)
+        for pos in range(0, len(uuids), 500):
+            chunk = uuids[pos:pos + 500]
+            sql = "SELECT uuid, md5, size, gs_url FROM resolved WHERE fetched >= ? AND uuid IN ({})".format(
+                ','.join('?' * len(chunk)))
+            with self._lock:
+                rows = self._db.execute(sql, [oldest] + chunk).fetchall()
+            for uuid, md5, size, gs_url in rows:
+                found[uuid] = {'md5': md5, 'size': size, 'gs_url': gs_url}
+        return found
+
+    def put_many(self, records):
+        """
+        Store (uuid, {'md5', 'size', 'gs_url'}) pairs
+        """
+        now = time.time()
+        rows = [(uuid, rec['md5'], rec['size'], rec['gs_url'], now) for uuid, rec in records]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO resolved VALUES (?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+            self.stored += len(rows)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups > 0 else 0.0
+        print("Resolution cache: {} hits, {} misses ({:.1f}% hit rate), {} records stored".format(
+            self.hits, self.misses, rate, self.stored))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
 def build_pull_list_with_bq(manifest_table, indexd_table, project, tmp_dataset, tmp_bq,
                             tmp_bucket, tmp_bucket_file, local_file, do_batch):
     """
@@ -378,13 +1204,26 @@ def manifest_builder_sql(file_table, filter_dict_list, max_files):
     '''.format(file_table, all_filters, limit_clause)
 
 
-def bq_to_bucket_tsv(src_table, project, dataset, bucket_name, bucket_file, do_batch, do_header):
+def bq_to_bucket_tsv(src_table, project, dataset, bucket_name, bucket_file, do_batch, do_header,
+                     sharded=False, compress=False, metrics=None):
     """
     Get a BQ Result to a Bucket TSV file
     Export BQ table to a cloud bucket
+    A single-URI export fails for tables over 1 GB. With sharded set, BQ writes bucket_file-000000000000,
+    bucket_file-000000000001, ... instead (gzipped, with a .gz suffix, if compress is set); each shard
+    gets its own header if do_header is set. Use bucket_to_local with sharded=True to fetch them.
+    Shards left by an earlier export to the same name are deleted first, so they can't get stitched in.
+    compress is only supported with sharded, since bucket_to_local only unzips shards.
     """
-    client = bigquery.Client()
-    destination_uri = "gs://{}/{}".format(bucket_name, bucket_file)
+    if compress and not sharded:
+        print("compress=True needs sharded=True")
+        return False
+    client = _bq_client()
+    if sharded:
+        _delete_blobs_quietly(_list_shard_blobs(_storage_client(), bucket_name, bucket_file))
+        destination_uri = "gs://{}/{}".format(bucket_name, _shard_pattern(bucket_file, compress))
+    else:
+        destination_uri = "gs://{}/{}".format(bucket_name, bucket_file)
     dataset_ref = client.dataset(dataset, project=project)
     table_ref = dataset_ref.table(src_table)
 
@@ -394,38 +1233,85 @@ def bq_to_bucket_tsv(src_table, project, dataset, bucket_name, bucket_file, do_b
     location = 'US'
     job_config.field_delimiter = '\t'
     job_config.print_header = do_header
+    if compress:
+        job_config.compression = bigquery.Compression.GZIP
 
-    extract_job = client.extract_table(table_ref, destination_uri, location="US", job_config=job_config)
-
-    # Query
-    job_state = 'NOT_STARTED'
-    while job_state != 'DONE':
-        extract_job = client.get_job(extract_job.job_id, location=location)
-        print('Job {} is currently in state {}'.format(extract_job.job_id, extract_job.state))
-        job_state = extract_job.state
-        time.sleep(5)
-    print('Job {} is done with status'.format(extract_job.job_id))
-
-    extract_job = client.get_job(extract_job.job_id, location=location)
-    print('Job {} is done'.format(extract_job.job_id))
-    if extract_job.error_result is not None:
-        print('Error result!! {}'.format(extract_job.error_result))
-        return False
-    return True
+    manager = BQJobManager(client, location=location, metrics=metrics)
+    manager.submit_extract(table_ref, destination_uri, job_config)
+    return manager.wait_all_ok()
 
 
-def bucket_to_local(bucket_name, bucket_file, local_file):
+def bucket_to_local(bucket_name, bucket_file, local_file, sharded=False, do_header=False, num_threads=8,
+                    keep_shards=False):
     """
     Get a Bucket File to Local
     Export a cloud bucket file to the local filesystem
     No leading / in bucket_file name!!
+    With sharded set, bucket_file is the name given to a sharded bq_to_bucket_tsv, and the shards are
+    downloaded by num_threads threads. They are then stitched into local_file (uncompressed, keeping only
+    the first header if do_header is set), or with keep_shards, left next to local_file and returned
+    as a list in shard order for consumers that can stream them one at a time.
     """
-    storage_client = storage.Client()
+    if sharded:
+        client_pool.ensure_pool_size(num_threads)
+        return _shards_to_local(_storage_client(), bucket_name, bucket_file, local_file, do_header, num_threads,
+                                keep_shards)
+    storage_client = _storage_client()
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(bucket_file)  # no leading / in blob name!!
     blob.download_to_filename(local_file)
     return
 
+
+def _shard_pattern(bucket_file, compress):
+    return "{}-*{}".format(bucket_file, '.gz' if compress else '')
+
+
+def _list_shard_blobs(storage_client, bucket_name, bucket_file):
+    """
+    The bucket_file-NNNNNNNNNNNN[.gz] shards of a sharded extract, in shard order
+    """
+    shard_prefix = "{}-".format(bucket_file)
+    return sorted((blob for blob in storage_client.list_blobs(bucket_name, prefix=shard_prefix)
+                   if blob.name[len(shard_prefix):].split('.')[0].isdigit()), key=lambda blob: blob.name)
+
+
+def _shards_to_local(storage_client, bucket_name, bucket_file, local_file, do_header, num_threads, keep_shards):
+    """
+    Fetch the shards of a sharded extract concurrently, then stitch or keep them
+    """
+    shard_prefix = "{}-".format(bucket_file)
+    blobs = _list_shard_blobs(storage_client, bucket_name, bucket_file)
+    local_dir = os.path.dirname(os.path.abspath(local_file))
+    local_base = os.path.basename(local_file)
+    shard_files = []
+    for blob in blobs:
+        shard_files.append(os.path.join(local_dir, "{}-{}".format(local_base, blob.name[len(shard_prefix):])))
+
+    def fetch(blob_and_file):
+        blob_and_file[0].download_to_filename(blob_and_file[1])
+        return blob_and_file[1]
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(fetch, zip(blobs, shard_files)))
+    print("fetched {} shards of {} in {:.2f} s".format(len(shard_files), bucket_file, time.time() - start))
+    if keep_shards:
+        return shard_files
+
+    with open(local_file, 'wb') as outfile:
+        for count, shard_file in enumerate(shard_files):
+            if shard_file.endswith('.gz'):
+                shard_in = _gzip_module().open(shard_file, "rb")
+            else:
+                shard_in = open(shard_file, 'rb')
+            with shard_in:
+                if do_header and count > 0:
+                    shard_in.readline()
+                shutil.copyfileobj(shard_in, outfile, 1024 * 1024)
+            os.remove(shard_file)
+    return
+
 def build_manifest_filter(filter_dict_list):
     """
     Build a manifest filter using the list of filter items you can get from a GDC search
@@ -465,10 +1351,17 @@ def build_manifest_filter(filter_dict_list):
     return ''.join(whole_filter)
 
 
-def get_the_manifest(filter_string, api_url, manifest_file, max_files=None):
+def get_the_manifest(filter_string, api_url, manifest_file, max_files=None, page_size=None, num_workers=4,
+                     max_retries=3):
     """
     This function takes a JSON filter string and uses it to download a manifest from GDC
+    A single request is capped at 100000 files (anything past that is silently dropped) and is held in
+    memory. If page_size is given, the manifest is instead pulled as from/size windows by num_workers
+    threads, and written out page by page, in order, with duplicate ids dropped.
     """
+    if page_size is not None:
+        return _get_the_manifest_paged(filter_string, api_url, manifest_file, max_files, page_size,
+                                       num_workers, max_retries)
 
     #
     # 1) When putting the size and "return_type" : "manifest" args inside a POST document, the result comes
@@ -499,6 +1392,85 @@ def get_the_manifest(filter_string, api_url, manifest_file, max_files=None):
         return False
 
 
+def _get_the_manifest_paged(filter_string, api_url, manifest_file, max_files, page_size, num_workers,
+                            max_retries):
+    """
+    Paged get_the_manifest. The total is found with a size=0 JSON query; the pages are sorted by file
+    id so the windows do not shift, and no more than 2 * num_workers pages are held at once.
+    """
+    base_url = '{}?filters={}'.format(api_url, up.quote(filter_string))
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=num_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def fetch_page(window):
+        request_url = '{}&from={}&size={}&sort=file_id:asc&return_type=manifest'.format(base_url, *window)
+        page_resp = _get_with_retries(session, request_url, max_retries)
+        if page_resp.status_code != 200:
+            raise Exception("Problem downloading manifest page {}: HTTP Status Code: {} ({})".format(
+                request_url, page_resp.status_code, page_resp.content))
+        return page_resp.text.splitlines(True)
+
+    #
+    # Pages go to a temp file that only replaces manifest_file once they have all arrived, so a failure
+    # part way through leaves any earlier manifest alone:
+    #
+    tmp_file = "{}.tmp".format(manifest_file)
+    seen = set()
+    dups = 0
+    try:
+        count_url = '{}&size=0&format=json'.format(base_url)
+        resp = _get_with_retries(session, count_url, max_retries)
+        if resp.status_code != 200:
+            print()
+            print("Request URL: {} ".format(count_url))
+            print("Problem getting manifest size. HTTP Status Code: {}".format(resp.status_code))
+            print("HTTP content: {}".format(resp.content))
+            return False
+        total = resp.json()['data']['pagination']['total']
+        if max_files is not None:
+            total = min(total, max_files)
+        windows = [(start, min(page_size, total - start)) for start in range(0, total, page_size)]
+        if not windows:
+            windows = [(0, 1)]  # still want the header line
+        print("Pulling manifest for {} files in {} pages".format(total, len(windows)))
+
+        with open(tmp_file, mode='w') as localfile, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            in_flight = collections.deque()
+            next_page = 0
+            first = True
+            while next_page < len(windows) or in_flight:
+                while next_page < len(windows) and len(in_flight) < 2 * num_workers:
+                    in_flight.append(executor.submit(fetch_page, windows[next_page]))
+                    next_page += 1
+                lines = in_flight.popleft().result()
+                if not lines:
+                    continue
+                if first:
+                    localfile.write(lines[0])
+                    first = False
+                for line in lines[1:]:
+                    file_id = line.split('\t', 1)[0]
+                    if file_id in seen:
+                        dups += 1
+                        continue
+                    seen.add(file_id)
+                    localfile.write(line)
+        os.replace(tmp_file, manifest_file)
+    except Exception as ex:
+        print(ex)
+        return False
+    finally:
+        session.close()
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    print("Wrote out manifest file: {} ({} files, {} duplicates dropped)".format(manifest_file, len(seen), dups))
+    return True
+
+
 def create_clean_target(local_files_dir):
     """
     GDC download client builds a tree of files in directories. This routine clears the tree out if it exists.
@@ -517,13 +1489,10 @@ def create_clean_target(local_files_dir):
         os.makedirs(local_files_dir)
 
 
-def build_pull_list_with_indexd(manifest_file, indexd_max, indexd_url, local_file):
+def read_manifest(manifest_file):
     """
-    Generate a list of gs:// urls to pull down from a manifest, using indexD
+    Parse a GDC-style manifest (id, filename, md5, size, ...) into a dict keyed by file id
     """
-
-    # Parse the manifest file for uids, pull out other data too as a sanity check:
-
     manifest_vals = {}
     with open(manifest_file, 'r') as readfile:
         first = True
@@ -537,62 +1506,401 @@ def build_pull_list_with_indexd(manifest_file, indexd_max, indexd_url, local_fil
                 'md5': split_line[2],
                 'size': int(split_line[3])
             }
+    return manifest_vals
+
+
+def file_md5(file_name):
+    """
+    Hex md5 of a local file, read in chunks
+    """
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as readfile:
+        for chunk in iter(lambda: readfile.read(4 * 1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _get_with_retries(session, request_url, max_retries):
+    """
+    GET on a pooled session, retried with backoff on connection errors and 5xx responses. The last
+    response is returned whatever its status.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            resp = session.get(request_url)
+        except requests.exceptions.ConnectionError:
+            if attempt == max_retries:
+                raise
+            time.sleep(2 ** attempt)
+            continue
+        if resp.status_code >= 500 and attempt < max_retries:
+            time.sleep(2 ** attempt)
+            continue
+        return resp
+
+
+def _resolve_indexd_batch(session, indexd_url, uuid_list, manifest_vals, max_retries):
+    """
+    One batched IndexD GET, retried with backoff on connection errors and 5xx responses. Each record is
+    checked against the manifest, and only what we need from it is kept. Returns a list of
+    (did, {'md5', 'size', 'gs_url'}) in the order IndexD returned them.
+    """
+    request_url = '{}{}'.format(indexd_url, ','.join(uuid_list))
+    resp = _get_with_retries(session, request_url, max_retries)
+    resp.raise_for_status()
+
+    file_dict = resp.json()
+    results = []
+    for i in range(0, len(uuid_list)):
+        curr_record = file_dict['records'][i]
+        curr_id = curr_record['did']
+        manifest_record = manifest_vals[curr_id]
+        if curr_record['did'] != curr_id or \
+                        curr_record['hashes']['md5'] != manifest_record['md5'] or \
+                        curr_record['size'] != manifest_record['size']:
+            raise Exception(
+                "Expected data mismatch! {} vs. {}".format(str(curr_record), str(manifest_record)))
+        gs_urls = [g for g in curr_record['urls'] if g.startswith('gs://')]
+        if len(gs_urls) != 1:
+            raise Exception("More than one gs:// URI! {}".format(str(gs_urls)))
+        results.append((curr_id, {'md5': curr_record['hashes']['md5'],
+                                  'size': curr_record['size'],
+                                  'gs_url': gs_urls[0]}))
+    return results
+
+
+def build_pull_list_with_indexd(manifest_file, indexd_max, indexd_url, local_file, num_workers=1,
+                                max_retries=3, cache=None):
+    """
+    Generate a list of gs:// urls to pull down from a manifest, using indexD
+    The batched IndexD calls are run by num_workers threads sharing one pooled session, with no more
+    than 2 * num_workers batches in flight. Batches that fail with a 5xx are retried up to max_retries
+    times. The pull list is written in manifest order as the batches come back, to a temp file that
+    only replaces local_file once every file has been resolved.
+    If a ResolutionCache is given, only files it does not hold (or holds with an md5/size that no
+    longer matches the manifest) are sent to IndexD, and the new resolutions are added to it.
+    """
+
+    # Parse the manifest file for uids, pull out other data too as a sanity check:
+
+    manifest_vals = read_manifest(manifest_file)
 
     # Use IndexD to map to Google bucket URIs. Batch up IndexD calls to reduce API load:
 
     print("Pulling {} files from buckets...".format(len(manifest_vals)))
     max_per_call = indexd_max
-    indexd_results = {}
-    num_full_calls = len(manifest_vals) // max_per_call  # Python 3: // is classic integer floor!
-    num_final_call = len(manifest_vals) % max_per_call
-    all_calls = num_full_calls + (1 if (num_final_call > 0) else 0)
-    uuid_list = []
-    call_count = 0
-    for uuid in manifest_vals:
-        uuid_list.append(uuid)
-        list_len = len(uuid_list)
-        is_last = (num_final_call > 0) and (call_count == num_full_calls)
-        if list_len == max_per_call or (is_last and list_len == num_final_call):
-            request_url = '{}{}'.format(indexd_url, ','.join(uuid_list))
-            resp = requests.request("GET", request_url)
-            call_count += 1
-            print ("completed {} of {} calls to IndexD".format(call_count, all_calls))
-            file_dict = json_loads(resp.text)
-            for i in range(0, list_len):
-                call_id = uuid_list[i]
-                curr_record = file_dict['records'][i]
-                curr_id = curr_record['did']
-                manifest_record = manifest_vals[curr_id]
-                indexd_results[curr_id] = curr_record
-                if curr_record['did'] != curr_id or \
-                                curr_record['hashes']['md5'] != manifest_record['md5'] or \
-                                curr_record['size'] != manifest_record['size']:
-                    raise Exception(
-                        "Expected data mismatch! {} vs. {}".format(str(curr_record), str(manifest_record)))
-            uuid_list.clear()
+    uuids = list(manifest_vals.keys())
+    resolved = {}
+    if cache is not None:
+        for uuid, record in cache.get_many(uuids).items():
+            manifest_record = manifest_vals[uuid]
+            if record['md5'] == manifest_record['md5'] and record['size'] == manifest_record['size']:
+                resolved[uuid] = record
+        cache.hits += len(resolved)
+        cache.misses += len(uuids) - len(resolved)
+    misses = [uuid for uuid in uuids if uuid not in resolved]
+    batches = [misses[pos:pos + max_per_call] for pos in range(0, len(misses), max_per_call)]
+    all_calls = len(batches)
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=num_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
 
     # Create a list of URIs to pull, write to specified file:
 
-    with open(local_file, mode='w') as pull_list_file:
-        for uid, record in indexd_results.items():
-            url_list = record['urls']
-            gs_urls = [g for g in url_list if g.startswith('gs://')]
-            if len(gs_urls) != 1:
-                raise Exception("More than one gs:// URI! {}".format(str(gs_urls)))
-            pull_list_file.write(gs_urls[0] + '\n')
+    call_count = 0
+    write_pos = 0
+    tmp_file = "{}.tmp".format(local_file)
+    try:
+        with open(tmp_file, mode='w') as pull_list_file, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            in_flight = collections.deque()
+            next_batch = 0
+            while True:
+                # Write out everything we can, in manifest order:
+                while write_pos < len(uuids) and uuids[write_pos] in resolved:
+                    pull_list_file.write(resolved.pop(uuids[write_pos])['gs_url'] + '\n')
+                    write_pos += 1
+                if next_batch >= all_calls and not in_flight:
+                    break
+                while next_batch < all_calls and len(in_flight) < 2 * num_workers:
+                    in_flight.append(executor.submit(_resolve_indexd_batch, session, indexd_url,
+                                                     batches[next_batch], manifest_vals, max_retries))
+                    next_batch += 1
+                results = in_flight.popleft().result()
+                call_count += 1
+                print("completed {} of {} calls to IndexD".format(call_count, all_calls))
+                resolved.update(results)
+                if cache is not None:
+                    cache.put_many(results)
+        if write_pos != len(uuids):
+            missing = [uuid for uuid in uuids[write_pos:] if uuid not in resolved]
+            raise Exception("IndexD never returned {} of the {} files, e.g. {}".format(
+                len(missing), len(uuids), ', '.join(missing[:5])))
+        os.replace(tmp_file, local_file)
+    finally:
+        session.close()
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    if cache is not None:
+        cache.report()
+    return
+
+
+def _permanent_gcs_error(ex):
+    """
+    Errors that another attempt won't fix: the object is missing, or we may not read it. A 403 that is
+    only rate limiting is not one of them.
+    """
+    if isinstance(ex, (exceptions.NotFound, exceptions.Unauthorized, exceptions.BadRequest)):
+        return True
+    return isinstance(ex, exceptions.Forbidden) and 'rateLimitExceeded' not in str(ex)
+
+
+def _with_retries(func, max_retries, retry_backoff, on_retry=None):
+    """
+    Call func, retrying up to max_retries times on an exception, sleeping retry_backoff * 2 ** attempt
+    seconds in between. Permanent errors (see _permanent_gcs_error) are raised straight away. on_retry,
+    if given, is called before each retry.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as ex:
+            if attempt == max_retries or _permanent_gcs_error(ex):
+                raise
+            if on_retry is not None:
+                on_retry()
+            time.sleep(retry_backoff * (2 ** attempt))
+
+
+def sliced_download(blob, full_file, size, slice_size=32 * 1024 * 1024, slice_threads=8, expected_md5=None,
+                    max_retries=3, retry_backoff=1.0, on_retry=None):
+    """
+    Download one large object as concurrent byte ranges. The local file is preallocated, and each
+    range is written into place with a positional write. Each range gets retried on its own (see
+    _with_retries). If expected_md5 is given, the finished file is checked against it. Only
+    blob.download_as_bytes(start, end) is used (end is inclusive), so this can be run against a local
+    fake object store.
+    """
+    fd = os.open(full_file, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if size > 0:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+
+        def fetch_range(start):
+            end = min(start + slice_size, size) - 1
+
+            def fetch():
+                data = blob.download_as_bytes(start=start, end=end)
+                if len(data) != end - start + 1:
+                    raise Exception("Short read for bytes {}-{}: got {}".format(start, end, len(data)))
+                os.pwrite(fd, data, start)
+                return len(data)
+
+            return _with_retries(fetch, max_retries, retry_backoff, on_retry)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=slice_threads) as executor:
+            fetched = sum(executor.map(fetch_range, range(0, size, slice_size)))
+    finally:
+        os.close(fd)
 
+    if fetched != size:
+        raise Exception("Sliced download of {} got {} of {} bytes".format(full_file, fetched, size))
+    if expected_md5 is not None and file_md5(full_file) != expected_md5:
+        raise Exception("md5 mismatch on sliced download of {}".format(full_file))
     return
 
 
+def _download_blob(blob, full_file, expected, slice_threshold, slice_size, slice_threads, max_retries=3,
+                   retry_backoff=2.0, on_retry=None):
+    """
+    Download a blob, using a sliced range download when slicing is turned on and the object is at
+    least slice_threshold bytes. expected is the manifest record for the file, if we have one.
+    This is the only retry layer: a whole-object download is retried as a unit, a sliced one range by
+    range, each up to max_retries times with retry_backoff * 2 ** attempt second sleeps.
+    The download goes to a temp file that is renamed over full_file once it is complete, so an
+    existing full_file (which may be hard-linked to a DownloadCache entry) is never rewritten in
+    place, and a failed download never leaves a partial file behind. Returns True if the file was
+    checked against the expected md5.
+    """
+    tmp_file = "{}.tmp-{}".format(full_file, threading.get_ident())
+    verified = False
+    try:
+        sliced = False
+        if slice_threshold is not None:
+            if expected is not None:
+                size = expected['size']
+            else:
+                _with_retries(blob.reload, max_retries, retry_backoff, on_retry)  # picks up the size
+                size = blob.size
+            if size >= slice_threshold:
+                sliced_download(blob, tmp_file, size, slice_size, slice_threads,
+                                None if expected is None else expected['md5'], max_retries, retry_backoff,
+                                on_retry)
+                sliced = True
+                verified = expected is not None
+        if not sliced:
+            _with_retries(lambda: blob.download_to_filename(tmp_file), max_retries, retry_backoff, on_retry)
+        os.replace(tmp_file, full_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return verified
+
+
+class DownloadCache(object):
+    """
+    Persistent content-addressed cache of downloaded files, keyed by the md5 that the manifests carry.
+    Files are hard-linked both ways, into the cache when added and into the target tree when found
+    (reflinked or copied if linking fails, e.g. across file systems), so adding costs no extra writes and
+    wiping local_files_dir with create_clean_target does not lose anything. A linked file and its entry
+    are then the same file: BucketPuller and the other writers here put a temp file in place with a
+    rename, which leaves the entry alone, but anything that rewrites a pulled file in place would change
+    the entry too. Only files that matched their md5 are added. The cache is kept under max_bytes by
+    evicting the least recently used entries, tracked in memory.
+    """
+    _FICLONE = 0x40049409
+
+    def __init__(self, cache_dir, max_bytes):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # path -> size, least recently used first:
+        self._index = collections.OrderedDict()
+        for path, size, _ in sorted(self._entries(), key=lambda entry: entry[2]):
+            self._index[path] = size
+        self._total_bytes = sum(self._index.values())
+        with self._lock:
+            self._evict()
+
+    def __str__(self):
+        return "DownloadCache"
+
+    def _path_for(self, md5):
+        return os.path.join(self._cache_dir, md5[:2], md5)
+
+    def _entries(self):
+        entries = []
+        for sub_dir in os.scandir(self._cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if '.tmp-' in entry.name:
+                    continue  # an add() in flight
+                stat = entry.stat()
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _clone(self, src, dst):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), self._FICLONE, src_file.fileno())
+            return
+        except (OSError, NameError):
+            pass
+        shutil.copyfile(src, dst)
+
+    def link_into(self, md5, target_file):
+        """
+        If the cache has this md5, put it at target_file and return True. Returns False if it does not,
+        including when the entry is evicted (by another thread or process sharing the cache) before it
+        could be linked, so the caller falls back to a download.
+        """
+        cached = self._path_for(md5)
+        if not os.path.isfile(cached):
+            return False
+        try:
+            if os.path.lexists(target_file):
+                os.remove(target_file)
+            self._clone(cached, target_file)
+            os.utime(cached)  # mark as recently used
+            size = os.path.getsize(cached)
+        except OSError:
+            return False
+        with self._lock:
+            if cached in self._index:
+                self._index.move_to_end(cached)
+            else:
+                # added by another process sharing the cache
+                self._index[cached] = size
+                self._total_bytes += size
+        return True
+
+    def add(self, md5, source_file):
+        """
+        Put a freshly downloaded file, already checked against md5, into the cache, then evict as
+        needed to stay under max_bytes
+        """
+        cached = self._path_for(md5)
+        if os.path.isfile(cached):
+            return
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp_file = "{}.tmp-{}-{}".format(cached, os.getpid(), threading.get_ident())
+        self._clone(source_file, tmp_file)
+        os.replace(tmp_file, cached)
+        with self._lock:
+            if cached not in self._index:
+                self._index[cached] = os.path.getsize(cached)
+                self._total_bytes += self._index[cached]
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held
+        while self._total_bytes > self._max_bytes and self._index:
+            path, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
 class BucketPuller(object):
-    """Multithreaded  bucket puller"""
-    def __init__(self, thread_count):
+    """
+    Multithreaded  bucket puller
+    Threads take their next URL off a shared queue, so one thread stuck with a few huge files does not
+    leave the others idle. Each download is retried up to max_retries times with exponential backoff,
+    unless the error is permanent (not found, forbidden).
+    Objects of slice_threshold bytes or more (if set) are fetched as slice_size byte ranges by
+    slice_threads concurrent requests, and checked against the manifest md5 when there is one.
+    If a DownloadCache is given, files the manifest md5 finds in the cache are linked in instead of
+    being pulled, and new downloads are added to the cache.
+    Progress goes to a "pull" stage of metrics (a PipelineMetrics); by default one that just draws the
+    progress bar.
+    """
+    def __init__(self, thread_count, max_retries=3, retry_backoff=2.0, slice_threshold=None,
+                 slice_size=32 * 1024 * 1024, slice_threads=8, cache=None, metrics=None):
         self._lock = threading.Lock()
         self._threads = []
         self._total_files = 0
-        self._read_files = 0
         self._thread_count = thread_count
-        self._bar_bump = 0
+        self._metrics = PipelineMetrics(renderers=[ProgressBarRenderer()]) if metrics is None else metrics
+        self._stage = None
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._slice_threshold = slice_threshold
+        self._slice_size = slice_size
+        self._slice_threads = slice_threads
+        self._cache = cache
+        self._cached_files = 0
+        self._work = None
+        self._expected = {}
+        self._skip_present = False
+        self._verify_md5 = False
+        self._skipped_files = 0
+        self._failed = []
+        self._thread_stats = []
 
     def __str__(self):
         return "BucketPuller"
@@ -600,64 +1908,154 @@ class BucketPuller(object):
     def reset(self):
         self._threads.clear()
         self._total_files = 0
-        self._read_files = 0
-        self._bar_bump = 0
-
-    def pull_from_buckets(self, pull_list, local_files_dir):
+        self._stage = None
+        self._work = None
+        self._expected = {}
+        self._skip_present = False
+        self._verify_md5 = False
+        self._skipped_files = 0
+        self._cached_files = 0
+        self._failed = []
+        self._thread_stats = []
+
+    def pull_from_buckets(self, pull_list, local_files_dir, manifest_file=None, skip_present=False,
+                          verify_md5=False):
         """
-          List of all project IDs
+        Pull every gs:// URL in pull_list down into the local_files_dir tree.
+        With skip_present, files already on disk are left alone if they match the size (and, with
+        verify_md5, the md5) that manifest_file lists for them; this lets an interrupted pull resume.
+        Returns True if every file was pulled or skipped, False if some failed after all the retries.
+        Counts and failures are for this call only; a BucketPuller can be used for several pulls.
         """
+        self.reset()
         self._total_files = len(pull_list)
-        self._bar_bump = self._total_files // 100
-        if self._bar_bump == 0:
-            self._bar_bump = 1
-        size = self._total_files // self._thread_count
-        size = size if self._total_files % self._thread_count == 0 else size + 1
-        chunks = [pull_list[pos:pos + size] for pos in range(0, self._total_files, size)]
-        for i in range(0, self._thread_count):
-            th = threading.Thread(target=self._pull_func, args=(chunks[i], local_files_dir))
+        self._stage = self._metrics.start_stage('pull', total=self._total_files)
+        self._skip_present = skip_present
+        self._verify_md5 = verify_md5
+        if manifest_file is not None:
+            self._expected = read_manifest(manifest_file)
+        elif self._cache is not None:
+            print("The download cache needs a manifest_file for the md5 keys; not using it")
+        if manifest_file is None and skip_present:
+            print("skip_present needs a manifest_file to check against; pulling everything")
+            self._skip_present = False
+
+        self._work = queue.Queue()
+        for url in pull_list:
+            self._work.put(url)
+
+        num_threads = max(1, min(self._thread_count, self._total_files))
+        # All the threads share one storage client, which needs a connection per concurrent request:
+        client_pool.ensure_pool_size(num_threads * (1 if self._slice_threshold is None else self._slice_threads))
+        for i in range(0, num_threads):
+            self._thread_stats.append({'files': 0, 'bytes': 0, 'seconds': 0.0})
+            th = threading.Thread(target=self._pull_func, args=(i, local_files_dir))
             self._threads.append(th)
 
-        for i in range(0, self._thread_count):
-            self._threads[i].start()
-
-        for i in range(0, self._thread_count):
-            self._threads[i].join()
-
-        print_progress_bar(self._read_files, self._total_files)
-        return
-
-    def _pull_func(self, pull_list, local_files_dir):
-        storage_client = storage.Client()
-        for url in pull_list:
-            path_pieces = up.urlparse(url)
-            dir_name = os.path.dirname(path_pieces.path)
-            make_dir = "{}{}".format(local_files_dir, dir_name)
-            os.makedirs(make_dir, exist_ok=True)
-            bucket = storage_client.bucket(path_pieces.netloc)
-            blob = bucket.blob(path_pieces.path[1:])  # drop leading / from blob name
-            full_file = "{}{}".format(local_files_dir, path_pieces.path)
-            blob.download_to_filename(full_file)
-            self._bump_progress()
-
-    def _bump_progress(self):
+        for th in self._threads:
+            th.start()
+
+        for th in self._threads:
+            th.join()
+
+        self._metrics.end_stage(self._stage)
+        self._report()
+        return len(self._failed) == 0
+
+    def _report(self):
+        if self._skipped_files > 0:
+            print("skipped {} files already present".format(self._skipped_files))
+        if self._cached_files > 0:
+            print("linked {} files from the download cache".format(self._cached_files))
+        for i, stats in enumerate(self._thread_stats):
+            rate = stats['bytes'] / stats['seconds'] / 1e6 if stats['seconds'] > 0 else 0.0
+            print("thread {}: {} files, {:.1f} MB in {:.1f} s, {:.1f} MB/s".format(
+                i, stats['files'], stats['bytes'] / 1e6, stats['seconds'], rate))
+        for url, ex in self._failed:
+            print("FAILED: {} ({})".format(url, ex))
+
+    def _expected_record(self, path_pieces):
+        # GDC bucket paths look like /<file uuid>/<file name>
+        uuid = path_pieces.path.split('/')[1]
+        return self._expected.get(uuid)
+
+    def _already_present(self, full_file, expected):
+        if expected is None or not os.path.isfile(full_file):
+            return False
+        if os.path.getsize(full_file) != expected['size']:
+            return False
+        if self._verify_md5 and file_md5(full_file) != expected['md5']:
+            return False
+        return True
 
-        with self._lock:
-            self._read_files += 1
-            if (self._read_files % self._bar_bump) == 0:
-                print_progress_bar(self._read_files, self._total_files)
+    def _pull_func(self, thread_idx, local_files_dir):
+        storage_client = _storage_client()
+        stats = self._thread_stats[thread_idx]
+        while True:
+            try:
+                url = self._work.get_nowait()
+            except queue.Empty:
+                return
+            start = time.time()
+            pulled_bytes = None
+            try:
+                path_pieces = up.urlparse(url)
+                dir_name = os.path.dirname(path_pieces.path)
+                make_dir = "{}{}".format(local_files_dir, dir_name)
+                os.makedirs(make_dir, exist_ok=True)
+                full_file = "{}{}".format(local_files_dir, path_pieces.path)
+                expected = self._expected_record(path_pieces)
+                if self._skip_present and self._already_present(full_file, expected):
+                    with self._lock:
+                        self._skipped_files += 1
+                    self._metrics.add(self._stage, files=1, skipped=1)
+                    continue
+                use_cache = self._cache is not None and expected is not None
+                if use_cache and self._cache.link_into(expected['md5'], full_file):
+                    with self._lock:
+                        self._cached_files += 1
+                    self._metrics.add(self._stage, files=1, cached=1)
+                    continue
+                bucket = storage_client.bucket(path_pieces.netloc)
+                blob = bucket.blob(path_pieces.path[1:])  # drop leading / from blob name
+                verified = _download_blob(blob, full_file, expected, self._slice_threshold, self._slice_size,
+                                          self._slice_threads, self._max_retries, self._retry_backoff,
+                                          lambda: self._metrics.add(self._stage, retries=1))
+                pulled_bytes = os.path.getsize(full_file)
+                stats['files'] += 1
+                stats['bytes'] += pulled_bytes
+                if use_cache and pulled_bytes == expected['size']:
+                    if verified or file_md5(full_file) == expected['md5']:
+                        self._cache.add(expected['md5'], full_file)
+                    else:
+                        print("md5 mismatch on {}; not adding it to the download cache".format(full_file))
+            except Exception as ex:
+                with self._lock:
+                    self._failed.append((url, ex))
+            stats['seconds'] += time.time() - start
+            if pulled_bytes is None:
+                self._metrics.add(self._stage, files=1, failed=1)
+            else:
+                self._metrics.add(self._stage, files=1, num_bytes=pulled_bytes)
 
 
-def pull_from_buckets(pull_list, local_files_dir):
+def pull_from_buckets(pull_list, local_files_dir, slice_threshold=None, slice_size=32 * 1024 * 1024,
+                      slice_threads=8, manifest_file=None, max_retries=3, retry_backoff=2.0):
     """
     Run the "Download Client", which now justs hauls stuff out of the cloud buckets
+    Objects of slice_threshold bytes or more (if set) are fetched as concurrent byte ranges, and checked
+    against the md5 in manifest_file if one is given, as BucketPuller does. Downloads are retried up to
+    max_retries times with retry_backoff * 2 ** attempt second sleeps.
     """
 
     # Parse the manifest file for uids, pull out other data too as a sanity check:
 
+    expected_vals = {} if manifest_file is None else read_manifest(manifest_file)
     num_files = len(pull_list)
     print("Begin {} bucket copies...".format(num_files))
-    storage_client = storage.Client()
+    if slice_threshold is not None:
+        client_pool.ensure_pool_size(slice_threads)
+    storage_client = _storage_client()
     copy_count = 0
     for url in pull_list:
         path_pieces = up.urlparse(url)
@@ -667,39 +2065,284 @@ def pull_from_buckets(pull_list, local_files_dir):
         bucket = storage_client.bucket(path_pieces.netloc)
         blob = bucket.blob(path_pieces.path[1:])  # drop leading / from blob name
         full_file = "{}{}".format(local_files_dir, path_pieces.path)
-        blob.download_to_filename(full_file)
+        # GDC bucket paths look like /<file uuid>/<file name>
+        expected = expected_vals.get(path_pieces.path.split('/')[1])
+        _download_blob(blob, full_file, expected, slice_threshold, slice_size, slice_threads, max_retries,
+                       retry_backoff)
         copy_count += 1
         if (copy_count % 10) == 0:
             print_progress_bar(copy_count, num_files)
     print_progress_bar(num_files, num_files)
 
-def build_file_list(local_files_dir):
+def build_file_list(local_files_dir, num_threads=1, inventory_file=None, changed_only=False):
     """
     Build the File List
     Using the tree of downloaded files, we build a file list. Note that we see the downloads
     (using the GDC download tool) bringing along logs and annotation.txt files, which we
     specifically omit.
+    With num_threads > 1 or an inventory_file, the tree is read by scan_tree instead of os.walk (same
+    files, same order). With changed_only set, only the files that are new or changed since the last
+    committed inventory_file are returned. The new sizes and mtimes are only staged next to it, in
+    "<inventory_file>.pending": call commit_inventory(inventory_file) once the files have been processed,
+    so that a failed run sees the same files as changed again next time.
     """
     print("building file list from {}".format(local_files_dir))
     all_files = []
-    for path, dirs, files in os.walk(local_files_dir):
-        if not path.endswith('logs'):
-            for f in files:
-                if f != 'annotations.txt':
-                    if f.endswith('parcel'):
-                        raise Exception
-                    all_files.append('{}/{}'.format(path, f))
+    if num_threads == 1 and inventory_file is None:
+        for path, dirs, files in os.walk(local_files_dir):
+            if not path.endswith('logs'):
+                for f in files:
+                    if f != 'annotations.txt':
+                        if f.endswith('parcel'):
+                            raise Exception
+                        all_files.append('{}/{}'.format(path, f))
+        print("done building file list from {}".format(local_files_dir))
+        return all_files
+
+    inventory = {}
+    for path, file_name, size, mtime_ns in scan_tree(local_files_dir, num_threads):
+        if not os.path.dirname(path).endswith('logs') and file_name != 'annotations.txt':
+            if file_name.endswith('parcel'):
+                raise Exception
+            all_files.append(path)
+            inventory[path] = [size, mtime_ns]
+
+    if inventory_file is not None:
+        previous = {}
+        if os.path.exists(inventory_file):
+            with open(inventory_file, 'r') as inventory_in:
+                previous = json_loads(inventory_in.read())
+        changed = [path for path in all_files if previous.get(path) != inventory[path]]
+        removed = len([path for path in previous if path not in inventory])
+        print("inventory: {} files, {} new or changed, {} removed".format(len(all_files), len(changed), removed))
+        pending_file = "{}.pending".format(inventory_file)
+        tmp_file = "{}.tmp".format(pending_file)
+        with open(tmp_file, 'w') as inventory_out:
+            inventory_out.write(json_dumps(inventory))
+        os.replace(tmp_file, pending_file)
+        if changed_only:
+            all_files = changed
 
     print("done building file list from {}".format(local_files_dir))
     return all_files
 
 
-def generic_bq_harness(sql, target_dataset, dest_table, do_batch, do_replace):
+def commit_inventory(inventory_file):
+    """
+    Commit the Inventory
+    Make the inventory staged by the last build_file_list(inventory_file=...) call the one that the
+    next changed_only run compares against. Call this only after the listed files were processed OK.
+    Returns False if there is nothing staged.
+    """
+    pending_file = "{}.pending".format(inventory_file)
+    if not os.path.exists(pending_file):
+        print("no pending inventory for {}".format(inventory_file))
+        return False
+    os.replace(pending_file, inventory_file)
+    return True
+
+
+def _scan_dir(path):
+    """
+    One scandir pass: returns the (name, size, mtime_ns) of each file, and the subdirectory paths
+    """
+    files = []
+    sub_dirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                # Like os.walk, symlinked directories are listed but not followed:
+                if not entry.is_symlink():
+                    sub_dirs.append(os.path.join(path, entry.name))
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                stat = entry.stat(follow_symlinks=False)
+            files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return files, sub_dirs
+
+
+def scan_tree(top_dir, num_threads=8):
+    """
+    List a directory tree with one os.scandir call per directory, spread over num_threads threads, so
+    network disks are not waited on one directory at a time. The sizes and mtimes come from the scandir
+    entries. Returns a list of (path, name, size, mtime_ns) in the same order that walking the tree
+    with os.walk would produce, with paths built the same way.
+    """
+    scanned = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = {executor.submit(_scan_dir, top_dir): top_dir}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    files, sub_dirs = future.result()
+                except OSError:
+                    files, sub_dirs = [], []  # os.walk skips unreadable directories too
+                scanned[path] = (files, sub_dirs)
+                for sub_dir in sub_dirs:
+                    pending[executor.submit(_scan_dir, sub_dir)] = sub_dir
+
+    results = []
+    stack = [top_dir]
+    while stack:
+        path = stack.pop()
+        files, sub_dirs = scanned[path]
+        for file_name, size, mtime_ns in files:
+            results.append(('{}/{}'.format(path, file_name), file_name, size, mtime_ns))
+        stack.extend(reversed(sub_dirs))
+    return results
+
+
+class BQJobManager(object):
+    """
+    Submit any number of BigQuery query, extract and load jobs, then wait on all of them together.
+    Polling backs off from min_poll up to max_poll seconds, so short jobs are noticed quickly without
+    hammering the API on long ones. wait_all() returns a status dict per job with the state, errors,
+    bytes processed, slot-ms (query jobs only) and elapsed time.
+    If a PipelineMetrics is given, each finished job is counted in a "bq" stage, and its status dict is
+    recorded as a trace event.
+    A transient error polling one job (rate limiting, a 5xx, a dropped connection) just means that job
+    is polled again next round; only after max_poll_errors of them in a row does wait_all() give up.
+    """
+    def __init__(self, client=None, location='US', min_poll=0.5, max_poll=10.0, metrics=None, max_poll_errors=5):
+        self._client = _bq_client() if client is None else client
+        self._location = location
+        self._min_poll = min_poll
+        self._max_poll = max_poll
+        self._max_poll_errors = max_poll_errors
+        self._jobs = []
+        self._metrics = metrics
+        self._stage = None
+
+    def __str__(self):
+        return "BQJobManager"
+
+    def _add(self, job, label):
+        if self._metrics is not None and self._stage is None:
+            self._stage = self._metrics.start_stage('bq')
+        self._jobs.append({'label': job.job_id if label is None else label, 'job': job, 'submitted': time.time(),
+                           'finished': None, 'state': job.state, 'poll_errors': 0})
+        return job
+
+    def submit_query(self, sql, job_config, label=None):
+        return self._add(self._client.query(sql, location=self._location, job_config=job_config), label)
+
+    def submit_extract(self, table_ref, destination_uri, job_config, label=None):
+        return self._add(self._client.extract_table(table_ref, destination_uri, location=self._location,
+                                                    job_config=job_config), label)
+
+    def submit_load(self, source_uri, table_ref, job_config, label=None):
+        return self._add(self._client.load_table_from_uri(source_uri, table_ref, location=self._location,
+                                                          job_config=job_config), label)
+
+    def wait_all(self):
+        """
+        Wait for every submitted job to finish. Returns the list of status dicts, in submission order.
+        """
+        poll = self._min_poll
+        pending = [rec for rec in self._jobs if rec['finished'] is None]
+        while pending:
+            still_pending = []
+            for rec in pending:
+                try:
+                    job = self._client.get_job(rec['job'].job_id, location=self._location)
+                except Exception as ex:
+                    if not self._transient_poll_error(ex) or rec['poll_errors'] >= self._max_poll_errors:
+                        raise
+                    rec['poll_errors'] += 1
+                    print('Polling job {} failed, will retry: {}'.format(rec['job'].job_id, ex))
+                    still_pending.append(rec)
+                    continue
+                rec['poll_errors'] = 0
+                rec['job'] = job
+                if job.state != rec['state']:
+                    print('Job {} is currently in state {}'.format(job.job_id, job.state))
+                    rec['state'] = job.state
+                if job.state == 'DONE':
+                    rec['finished'] = time.time()
+                    if self._metrics is not None:
+                        status = self._status(rec)
+                        self._metrics.add(self._stage, jobs=1, failed=0 if status['error_result'] is None else 1,
+                                          num_bytes=status['bytes_processed'] or 0)
+                        self._metrics.record_event(self._stage, status)
+                else:
+                    still_pending.append(rec)
+            pending = still_pending
+            if pending:
+                time.sleep(poll)
+                poll = min(poll * 1.5, self._max_poll)
+            elif self._metrics is not None:
+                self._metrics.end_stage(self._stage)
+        return [self._status(rec) for rec in self._jobs]
+
+    def wait_all_ok(self):
+        """
+        Wait for the jobs, print how each one went, and return True if none of them failed
+        """
+        return self.check_statuses(self.wait_all())
+
+    @staticmethod
+    def check_statuses(statuses):
+        """
+        Print how each job in a wait_all() result went, and return True if none of them failed
+        """
+        all_ok = True
+        for status in statuses:
+            print('Job {} is done: {} bytes, {} slot-ms, {:.1f} s'.format(
+                status['job_id'], status['bytes_processed'], status['slot_millis'], status['elapsed']))
+            if status['error_result'] is not None:
+                print('Error result!! {}'.format(status['error_result']))
+                for err in status['errors'] or []:
+                    print(err)
+                all_ok = False
+        return all_ok
+
+    @staticmethod
+    def _transient_poll_error(ex):
+        return _retryable_bq_error(ex) or isinstance(ex, (requests.exceptions.ConnectionError,
+                                                          requests.exceptions.Timeout))
+
+    @staticmethod
+    def _status(rec):
+        job = rec['job']
+        slot_millis = None
+        if job.job_type == 'query':
+            bytes_processed = job.total_bytes_processed
+            slot_millis = job.slot_millis
+        elif job.job_type == 'load':
+            bytes_processed = job.input_file_bytes
+        else:
+            bytes_processed = None
+        if job.started is not None and job.ended is not None:
+            elapsed = (job.ended - job.started).total_seconds()
+        else:
+            elapsed = rec['finished'] - rec['submitted']
+        return {
+            'label': rec['label'],
+            'job_id': job.job_id,
+            'job_type': job.job_type,
+            'state': job.state,
+            'error_result': job.error_result,
+            'errors': job.errors,
+            'bytes_processed': bytes_processed,
+            'slot_millis': None if slot_millis is None else int(slot_millis),
+            'elapsed': elapsed
+        }
+
+
+def generic_bq_harness(sql, target_dataset, dest_table, do_batch, do_replace, metrics=None):
     """
     Handles all the boilerplate for running a BQ job
     """
 
-    client = bigquery.Client()
+    client = _bq_client()
     job_config = bigquery.QueryJobConfig()
     if do_batch:
         job_config.priority = bigquery.QueryPriority.BATCH
@@ -711,148 +2354,688 @@ def generic_bq_harness(sql, target_dataset, dest_table, do_batch, do_replace):
     print(target_ref)
     location = 'US'
 
-    # API request - starts the query
-    query_job = client.query(sql, location=location, job_config=job_config)
-
-    # Query
-    job_state = 'NOT_STARTED'
-    while job_state != 'DONE':
-        query_job = client.get_job(query_job.job_id, location=location)
-        print('Job {} is currently in state {}'.format(query_job.job_id, query_job.state))
-        job_state = query_job.state
-        print(query_job)
-        time.sleep(5)
-    print('Job {} is done with status'.format(query_job.job_id))
-
-    query_job = client.get_job(query_job.job_id, location=location)
-    print('Job {} is done'.format(query_job.job_id))
-    if query_job.error_result is not None:
-        print('Error result!! {}'.format(query_job.error_result))
-        return False
-    return True
+    manager = BQJobManager(client, location=location, metrics=metrics)
+    manager.submit_query(sql, job_config)
+    return manager.wait_all_ok()
 
 
-def upload_to_bucket(target_tsv_bucket, target_tsv_file, local_tsv_file):
+def upload_to_bucket(target_tsv_bucket, target_tsv_file, local_tsv_file, part_size=None, num_threads=8,
+                     metrics=None):
     """
     Upload to Google Bucket
     Large files have to be in a bucket for them to be ingested into Big Query. This does this.
+    If part_size is given and the file is bigger than that, it goes up as part_size pieces uploaded by
+    num_threads threads, which are then composed into the target blob on the server side.
+    Parts and bytes sent are counted in an "upload" stage of metrics, if given.
     """
-    storage_client = storage.Client()
+    if part_size is not None:
+        client_pool.ensure_pool_size(num_threads)
+    storage_client = _storage_client()
     bucket = storage_client.get_bucket(target_tsv_bucket)
     blob = bucket.blob(target_tsv_file)
     print(blob.name)
-    blob.upload_from_filename(local_tsv_file)
+    metrics = PipelineMetrics() if metrics is None else metrics
+    file_size = os.path.getsize(local_tsv_file)
+    if part_size is None or file_size <= part_size:
+        stage = metrics.start_stage('upload', total=1)
+        blob.upload_from_filename(local_tsv_file)
+        metrics.add(stage, files=1, num_bytes=file_size)
+        metrics.end_stage(stage)
+        return
+
+    def upload_part(part_num):
+        offset = part_num * part_size
+        part_blob = bucket.blob(_part_blob_name(target_tsv_file, part_num))
+        with open(local_tsv_file, 'rb') as part_in:
+            part_in.seek(offset)
+            part_blob.upload_from_file(part_in, size=min(part_size, file_size - offset))
+        metrics.add(stage, files=1, num_bytes=min(part_size, file_size - offset))
+        return part_blob
+
+    num_parts = (file_size + part_size - 1) // part_size
+    stage = metrics.start_stage('upload', total=num_parts)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            part_blobs = list(executor.map(upload_part, range(num_parts)))
+        compose_blobs(bucket, blob, part_blobs)
+    except Exception:
+        # Don't leave the parts behind in the bucket:
+        _delete_blobs_quietly([bucket.blob(_part_blob_name(target_tsv_file, part_num))
+                               for part_num in range(num_parts)])
+        raise
+    metrics.end_stage(stage)
+    return
 
 
-def csv_to_bq(schema, csv_uri, dataset_id, targ_table, do_batch):
-    client = bigquery.Client()
+def _part_blob_name(target_file, part_num):
+    return "{}.part-{:06d}".format(target_file, part_num)
+
+
+def _delete_blobs_quietly(blobs):
+    """
+    Best-effort cleanup of temporary blobs; ones that are already gone (or were never uploaded) are fine
+    """
+    for blob in blobs:
+        try:
+            blob.delete()
+        except Exception:
+            pass
+    return
+
+
+def compose_blobs(bucket, target_blob, part_blobs, max_sources=32):
+    """
+    Compose part_blobs, in order, into target_blob, then delete the parts. GCS composes at most 32
+    sources per call, so bigger part lists are composed in rounds through intermediate blobs. If a
+    compose fails, the intermediate blobs made so far are deleted before the error is raised.
+    """
+    level = 0
+    inter_blobs = []
+    try:
+        while len(part_blobs) > max_sources:
+            next_round = []
+            for pos in range(0, len(part_blobs), max_sources):
+                group = part_blobs[pos:pos + max_sources]
+                inter_blob = bucket.blob("{}.compose-{}-{:06d}".format(target_blob.name, level, pos // max_sources))
+                inter_blob.compose(group)
+                inter_blobs.append(inter_blob)
+                for part_blob in group:
+                    part_blob.delete()
+                next_round.append(inter_blob)
+            part_blobs = next_round
+            level += 1
+        target_blob.compose(part_blobs)
+    except Exception:
+        _delete_blobs_quietly(inter_blobs)
+        raise
+    for part_blob in part_blobs:
+        part_blob.delete()
+    return
+
+
+class BucketStreamWriter(io.RawIOBase):
+    """
+    Write-only stream into a bucket blob, with no full local copy. Bytes are spooled into part_size
+    temp files under spool_dir; each full part is uploaded by a pool of num_threads threads while
+    writing goes on, and close() composes the parts into the target blob. At most num_threads + 1 parts
+    are on local disk at a time. Wrap it in io.TextIOWrapper(io.BufferedWriter(...)) for text.
+    If the writer fails part way, call abort() before the stream is closed (leaving a with block on the
+    writer itself by an exception does this). close() then deletes the uploaded parts instead of
+    composing them, so a truncated target blob is never published.
+    """
+    def __init__(self, target_bucket, target_file, part_size=256 * 1024 * 1024, num_threads=4, spool_dir=None):
+        super(BucketStreamWriter, self).__init__()
+        client_pool.ensure_pool_size(num_threads)
+        self._bucket = _storage_client().get_bucket(target_bucket)
+        self._target_file = target_file
+        self._part_size = part_size
+        self._num_threads = num_threads
+        self._spool_dir = spool_dir
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+        self._futures = []
+        self._in_flight = set()
+        self._spooled = []
+        self._part = None
+        self._part_bytes = 0
+        self._num_parts = 0
+        self._aborted = False
+        self.bytes_written = 0
+
+    def __str__(self):
+        return "BucketStreamWriter"
+
+    def writable(self):
+        return True
+
+    def abort(self):
+        self._aborted = True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        self.close()
+
+    def write(self, data):
+        data = memoryview(data)
+        if self._aborted:
+            # Whatever is still buffered above us gets flushed on the way out; drop it:
+            return len(data)
+        written = 0
+        while written < len(data):
+            if self._part is None:
+                self._part = tempfile.NamedTemporaryFile(dir=self._spool_dir, delete=False)
+                self._part_bytes = 0
+            chunk = data[written:written + self._part_size - self._part_bytes]
+            self._part.write(chunk)
+            self._part_bytes += len(chunk)
+            written += len(chunk)
+            if self._part_bytes >= self._part_size:
+                self._ship_part()
+        self.bytes_written += written
+        return written
+
+    def _ship_part(self):
+        self._part.close()
+        # Keep the number of parts waiting on local disk bounded. Only wait on the uploads still running,
+        # since wait() returns at once if any future it is given is already done:
+        self._in_flight = set(future for future in self._in_flight if not future.done())
+        while len(self._in_flight) >= self._num_threads:
+            self._in_flight = concurrent.futures.wait(self._in_flight,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED).not_done
+        future = self._executor.submit(self._upload_part, self._part.name, self._num_parts)
+        self._futures.append(future)
+        self._in_flight.add(future)
+        self._spooled.append(self._part.name)
+        self._num_parts += 1
+        self._part = None
+
+    def _upload_part(self, part_file, part_num):
+        try:
+            part_blob = self._bucket.blob(_part_blob_name(self._target_file, part_num))
+            part_blob.upload_from_filename(part_file)
+            return part_blob
+        finally:
+            os.remove(part_file)
+
+    def _discard_parts(self):
+        if self._part is not None:
+            self._part.close()
+            self._spooled.append(self._part.name)
+            self._part = None
+        for future in self._futures:
+            future.cancel()
+        concurrent.futures.wait(self._futures)
+        for part_file in self._spooled:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+        _delete_blobs_quietly([self._bucket.blob(_part_blob_name(self._target_file, part_num))
+                               for part_num in range(self._num_parts)])
+        return
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self._aborted:
+                if self._part is not None:
+                    self._ship_part()
+                part_blobs = [future.result() for future in self._futures]
+                target_blob = self._bucket.blob(self._target_file)
+                if not part_blobs:
+                    target_blob.upload_from_string(b'')
+                else:
+                    compose_blobs(self._bucket, target_blob, part_blobs)
+        except Exception:
+            self._aborted = True
+            raise
+        finally:
+            if self._aborted:
+                self._discard_parts()
+            self._executor.shutdown()
+            super(BucketStreamWriter, self).close()
+
+
+def csv_to_bq(schema, csv_uri, dataset_id, targ_table, do_batch, metrics=None):
+    return _load_to_bq(schema, csv_uri, dataset_id, targ_table, do_batch, 'CSV', metrics) is not None
+
+
+def parquet_to_bq(schema, parquet_uri, dataset_id, targ_table, do_batch, metrics=None):
+    """
+    Load Parquet staged by tsv_to_parquet. The column types come from the Parquet file itself; the
+    column descriptions in schema are installed on the table once the load is done.
+    """
+    return _load_to_bq(schema, parquet_uri, dataset_id, targ_table, do_batch, 'PARQUET', metrics) is not None
+
+
+def _load_to_bq(schema, uri, dataset_id, targ_table, do_batch, source_format, metrics=None):
+    """
+    Shared load job for csv_to_bq and parquet_to_bq. Returns the BQJobManager status dict of the job,
+    or None if it failed.
+    """
+    client = _bq_client()
 
     dataset_ref = client.dataset(dataset_id)
     job_config = bigquery.LoadJobConfig()
     if do_batch:
         job_config.priority = bigquery.QueryPriority.BATCH
 
-    schema_list = []
-    for dict in schema:
-        schema_list.append(bigquery.SchemaField(dict['name'], dict['type'].upper(),
-                                                mode='NULLABLE', description=dict['description']))
-
-    job_config.schema = schema_list
-    job_config.skip_leading_rows = 1
-    job_config.source_format = bigquery.SourceFormat.CSV
+    if source_format == 'CSV':
+        schema_list = []
+        for dict in schema:
+            schema_list.append(bigquery.SchemaField(dict['name'], dict['type'].upper(),
+                                                    mode='NULLABLE', description=dict['description']))
+
+        job_config.schema = schema_list
+        job_config.skip_leading_rows = 1
+        job_config.source_format = bigquery.SourceFormat.CSV
+        # Can make the "CSV" file a TSV file using this:
+        job_config.field_delimiter = '\t'
+    else:
+        job_config.source_format = bigquery.SourceFormat.PARQUET
     job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
-    # Can make the "CSV" file a TSV file using this:
-    job_config.field_delimiter = '\t'
-
-    load_job = client.load_table_from_uri(
-        csv_uri,
-        dataset_ref.table(targ_table),
-        job_config=job_config)  # API request
-    print('Starting job {}'.format(load_job.job_id))
 
     location = 'US'
-    job_state = 'NOT_STARTED'
-    while job_state != 'DONE':
-        load_job = client.get_job(load_job.job_id, location=location)
-        print('Job {} is currently in state {}'.format(load_job.job_id, load_job.state))
-        job_state = load_job.state
-        time.sleep(5)
-    print('Job {} is done with status'.format(load_job.job_id))
-
-    load_job = client.get_job(load_job.job_id, location=location)
-    print('Job {} is done'.format(load_job.job_id))
-    if load_job.error_result is not None:
-        print('Error result!! {}'.format(load_job.error_result))
-        for err in load_job.errors:
-            print(err)
-        return False
+    manager = BQJobManager(client, location=location, metrics=metrics)
+    load_job = manager.submit_load(uri, dataset_ref.table(targ_table), job_config)
+    print('Starting job {}'.format(load_job.job_id))
+    statuses = manager.wait_all()
+    if not manager.check_statuses(statuses):
+        return None
 
     destination_table = client.get_table(dataset_ref.table(targ_table))
+    if source_format != 'CSV' and schema:
+        # Parquet carries the types but not the descriptions:
+        descriptions = {field['name']: field['description'] for field in schema}
+        destination_table.schema = [bigquery.SchemaField(sf.name, sf.field_type, mode=sf.mode,
+                                                         description=descriptions.get(sf.name, sf.description))
+                                    for sf in destination_table.schema]
+        destination_table = client.update_table(destination_table, ["schema"])
     print('Loaded {} rows.'.format(destination_table.num_rows))
-    return True
+    return statuses[0]
 
 
-def concat_all_files(all_files, one_big_tsv, program_prefix, extra_cols, file_info_func, split_more_func):
+def tsv_to_parquet(local_tsv, parquet_file, typing_tups, block_size=64 * 1024 * 1024,
+                   row_group_rows=1000000):
+    """
+    Convert a TSV built by concat_all_files into typed Parquet, using the typing_tups column types.
+    The TSV is streamed through in blocks, and written out in row groups of about row_group_rows rows.
+    Empty fields become NULLs, as they would in a CSV load. BOOLEAN columns are read as strings and
+    lower-cased before conversion, so any mix of case that ColumnTypeTracker accepts (tRue, FALSE...)
+    converts, as it would in a CSV load. Needs pyarrow.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("tsv_to_parquet needs pyarrow: python3 -m pip install pyarrow")
+
+    arrow_types = {
+        'STRING': pa.string(),
+        'INTEGER': pa.int64(),
+        'INT64': pa.int64(),
+        'FLOAT': pa.float64(),
+        'FLOAT64': pa.float64(),
+        'BOOLEAN': pa.bool_(),
+        'BOOL': pa.bool_()
+    }
+    column_types = {name: arrow_types.get(bq_type.upper(), pa.string()) for name, bq_type in typing_tups}
+    bool_cols = set(name for name, col_type in column_types.items() if col_type == pa.bool_())
+    reader = pa_csv.open_csv(
+        local_tsv,
+        read_options=pa_csv.ReadOptions(block_size=block_size),
+        parse_options=pa_csv.ParseOptions(delimiter='\t', quote_char=False),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: (pa.string() if name in bool_cols else col_type)
+                          for name, col_type in column_types.items()},
+            null_values=[''], strings_can_be_null=True))
+    schema = pa.schema([field.with_type(pa.bool_()) if field.name in bool_cols else field
+                        for field in reader.schema])
+    num_rows = 0
+    pending = []
+    pending_rows = 0
+    with pq.ParquetWriter(parquet_file, schema, compression='snappy') as writer:
+        for batch in reader:
+            if bool_cols:
+                batch = pa.RecordBatch.from_arrays(
+                    [pc.equal(pc.utf8_lower(column), 'true') if name in bool_cols else column
+                     for name, column in zip(batch.schema.names, batch.columns)], schema=schema)
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            if pending_rows >= row_group_rows:
+                writer.write_table(pa.Table.from_batches(pending), row_group_size=pending_rows)
+                num_rows += pending_rows
+                pending = []
+                pending_rows = 0
+        if pending:
+            writer.write_table(pa.Table.from_batches(pending), row_group_size=pending_rows)
+            num_rows += pending_rows
+    print("wrote {} rows to {}".format(num_rows, parquet_file))
+    return num_rows
+
+
+def compare_staging_formats(local_tsv, schema_list_file, typing_tups, target_bucket, target_prefix,
+                            dataset_id, table_prefix, do_batch):
+    """
+    Stage the same TSV both ways (TSV loaded as CSV, and Parquet) into <table_prefix>_tsv and
+    <table_prefix>_parquet, and report the bytes uploaded and the upload and load times for each.
+    schema_list_file is the typed schema list written by build_combined_schema or
+    typing_tups_to_schema_list.
+    """
+    with open(schema_list_file, mode='r') as schema_in:
+        schema = json_loads(schema_in.read())
+
+    parquet_file = "{}.parquet".format(local_tsv)
+    start = time.time()
+    tsv_to_parquet(local_tsv, parquet_file, typing_tups)
+    convert_secs = time.time() - start
+
+    results = {}
+    for label, local_file, source_format in (('tsv', local_tsv, 'CSV'), ('parquet', parquet_file, 'PARQUET')):
+        blob_name = "{}.{}".format(target_prefix, label)
+        start = time.time()
+        upload_to_bucket(target_bucket, blob_name, local_file)
+        upload_secs = time.time() - start
+        status = _load_to_bq(schema, "gs://{}/{}".format(target_bucket, blob_name), dataset_id,
+                             "{}_{}".format(table_prefix, label), do_batch, source_format)
+        results[label] = {
+            'bytes_uploaded': os.path.getsize(local_file),
+            'upload_seconds': upload_secs,
+            'load_seconds': None if status is None else status['elapsed']
+        }
+    results['parquet']['convert_seconds'] = convert_secs
+
+    print("Staging format comparison for {}:".format(local_tsv))
+    for label, res in results.items():
+        print("   {:<8} {:>15,} bytes uploaded, upload {:.1f} s, load {} s".format(
+            label, res['bytes_uploaded'], res['upload_seconds'], res['load_seconds']))
+    print("   (Parquet conversion took {:.1f} s)".format(convert_secs))
+    return results
+
+
+class ColumnTypeTracker(object):
+    """
+    Single-pass schema type inference. Tracks the narrowest BigQuery type (BOOLEAN, INTEGER, FLOAT or
+    STRING) that fits every value seen so far in each column. Empty fields are NULLs and do not count;
+    a column with nothing but NULLs comes out as STRING. Numbers with a leading zero (007, -01.5) are
+    STRING too, since they are usually IDs or codes whose zeros a numeric load would lose. Columns are
+    dropped from the per-row work once they have widened to STRING.
+    """
+    _LEADING_ZERO_RE = re.compile(r'^[-+]?0[0-9]')
+    _INT_RE = re.compile(r'^[-+]?[0-9]+$')
+    _FLOAT_RE = re.compile(r'^[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$')
+    _INT64_MAX = 2 ** 63 - 1
+    _INT64_MIN = -(2 ** 63)
+
+    def __init__(self, col_names):
+        self._col_names = list(col_names)
+        self._types = [None] * len(self._col_names)
+        self._open_cols = list(range(len(self._col_names)))
+
+    def __str__(self):
+        return "ColumnTypeTracker"
+
+    def empty_copy(self):
+        return ColumnTypeTracker(self._col_names)
+
+    @classmethod
+    def value_type(cls, val):
+        if cls._LEADING_ZERO_RE.match(val):
+            return 'STRING'
+        if cls._INT_RE.match(val):
+            if cls._INT64_MIN <= int(val) <= cls._INT64_MAX:
+                return 'INTEGER'
+            return 'FLOAT'
+        if cls._FLOAT_RE.match(val):
+            return 'FLOAT'
+        if val.lower() in ('true', 'false'):
+            return 'BOOLEAN'
+        return 'STRING'
+
+    @staticmethod
+    def _widen(curr_type, val_type):
+        if curr_type is None or curr_type == val_type:
+            return val_type
+        if curr_type in ('INTEGER', 'FLOAT') and val_type in ('INTEGER', 'FLOAT'):
+            return 'FLOAT'
+        return 'STRING'
+
+    def add_row(self, split_line):
+        types = self._types
+        num_vals = len(split_line)
+        widened = False
+        for i in self._open_cols:
+            if i >= num_vals:
+                break
+            val = split_line[i]
+            if val == '':
+                continue
+            curr_type = types[i]
+            val_type = self.value_type(val)
+            if val_type != curr_type:
+                types[i] = self._widen(curr_type, val_type)
+                widened = widened or types[i] == 'STRING'
+        if widened:
+            self._open_cols = [i for i in self._open_cols if types[i] != 'STRING']
+
+    def merge(self, other):
+        for i, other_type in enumerate(other._types):
+            if other_type is not None:
+                self._types[i] = self._widen(self._types[i], other_type)
+        self._open_cols = [i for i in self._open_cols if self._types[i] != 'STRING']
+
+    def typing_tups(self):
+        return [(name, 'STRING' if col_type is None else col_type)
+                for name, col_type in zip(self._col_names, self._types)]
+
+
+def _uncompressed_name(filename):
+    """
+    File name minus any .zip or .gz suffix; this is what file_info_func gets to see.
+    """
+    if filename.endswith('.zip'):
+        return filename[:-4]
+    elif filename.endswith('.gz'):
+        return filename[:-3]
+    return filename
+
+
+def concat_all_files(all_files, one_big_tsv, program_prefix, extra_cols, file_info_func, split_more_func,
+                     num_procs=1, shard_dir=None, infer_types=False, metrics=None):
     """
     Concatenate all Files
     Gather up all files and glue them into one big one. The file name and path often include features
     that we want to add into the table. The provided file_info_func returns a list of elements from
-    the file path, and the extra_cols list maps these to extra column names. Note if file is zipped,
-    we unzip it, concat it, then toss the unzipped version.
+    the file path, and the extra_cols list maps these to extra column names. Note if file is zipped
+    or gzipped, we read the decompressed stream directly; nothing is inflated to disk.
     THIS VERSION OF THE FUNCTION USES THE FIRST LINE OF THE FIRST FILE TO BUILD THE HEADER LINE!
+    If num_procs > 1, the files are transformed into per-file shards by a process pool (shards go in a
+    temp directory under shard_dir, default is next to one_big_tsv), and then stitched together in order
+    behind the header. The result is identical to the serial path as long as file_info_func and
+    split_more_func are picklable and keep no state between calls.
+    If infer_types is True, a ColumnTypeTracker watches the rows as they are written, and the function
+    returns the typing_tups (column name, narrowest BigQuery type) for build_combined_schema or
+    typing_tups_to_schema_list, so the big TSV does not need to be read again.
+    Files, rows and (uncompressed) bytes read are counted in a "concat" stage of metrics, if given.
+    """
+    metrics = PipelineMetrics() if metrics is None else metrics
+    stage = metrics.start_stage('concat', total=len(all_files))
+    if num_procs > 1:
+        typing_tups = _concat_all_files_parallel(all_files, one_big_tsv, program_prefix, extra_cols,
+                                                 file_info_func, split_more_func, num_procs, shard_dir,
+                                                 infer_types, metrics, stage)
+    else:
+        print("building {}".format(one_big_tsv))
+        with open(one_big_tsv, 'w') as outfile:
+            typing_tups = _concat_all_files_to_handle(outfile, all_files, program_prefix, extra_cols,
+                                                      file_info_func, split_more_func, infer_types, metrics,
+                                                      stage)
+    metrics.end_stage(stage)
+    return typing_tups
+
+
+def _concat_all_files_to_handle(outfile, all_files, program_prefix, extra_cols, file_info_func, split_more_func,
+                                infer_types, metrics, stage):
+    """
+    The serial concat_all_files loop, writing to an open text handle (a local file, or a
+    BucketStreamWriter). Returns the typing_tups if infer_types is set, else None.
     """
-    print("building {}".format(one_big_tsv))
     first = True
     header_id = None
     hdr_line = None
-    with open(one_big_tsv, 'w') as outfile:
-        for filename in all_files:
-            toss_zip = False
-            if filename.endswith('.zip'):
-                dir_name = os.path.dirname(filename)
-                print("Unzipping {}".format(filename))
-                with zipfile.ZipFile(filename, "r") as zip_ref:
-                    zip_ref.extractall(dir_name)
-                use_file_name = filename[:-4]
-                toss_zip = True
-            elif filename.endswith('.gz'):
-                dir_name = os.path.dirname(filename)
-                use_file_name = filename[:-3]
-                print("Uncompressing {}".format(filename))
-                with gzip.open(filename, "rb") as gzip_in:
-                    with open(use_file_name, "wb") as uncomp_out:
-                        shutil.copyfileobj(gzip_in, uncomp_out)
-                toss_zip = True
-            else:
-                use_file_name = filename
-            if os.path.isfile(use_file_name):
-                with open(use_file_name, 'r') as readfile:
-                    file_info_list = file_info_func(use_file_name, program_prefix)
-                    for line in readfile:
-                        if line.startswith('#'):
-                            continue
-                        split_line = line.rstrip('\n').split("\t")
+    tracker = None
+    for filename in all_files:
+        use_file_name = _uncompressed_name(filename)
+        source = TextLineSource(filename)
+        rows = 0
+        with source as readfile:
+            if readfile is None:
+                print('{} was not found'.format(use_file_name))
+                metrics.add(stage, files=1, missing=1)
+                continue
+            file_info_list = file_info_func(use_file_name, program_prefix)
+            for line in readfile:
+                if line.startswith('#'):
+                    continue
+                split_line = line.rstrip('\n').split("\t")
+                if first:
+                    for col in extra_cols:
+                        split_line.append(col)
+                    header_id = split_line[0]
+                    hdr_line = split_line
+                    print("Header starts with {}".format(header_id))
+                else:
+                    for i in range(len(extra_cols)):
+                        split_line.append(file_info_list[i])
+                if not line.startswith(header_id) or first:
+                    if split_more_func is not None:
+                        split_line = split_more_func(split_line, hdr_line, first)
+                    if infer_types:
                         if first:
-                            for col in extra_cols:
-                                split_line.append(col)
-                            header_id = split_line[0]
-                            hdr_line = split_line
-                            print("Header starts with {}".format(header_id))
+                            tracker = ColumnTypeTracker(split_line)
                         else:
-                            for i in range(len(extra_cols)):
-                                split_line.append(file_info_list[i])
-                        if not line.startswith(header_id) or first:
-                            if split_more_func is not None:
-                                split_line = split_more_func(split_line, hdr_line, first)
-                            outfile.write('\t'.join(split_line))
-                            outfile.write('\n')
-                        first = False
-            else:
-                print('{} was not found'.format(use_file_name))
+                            tracker.add_row(split_line)
+                    outfile.write('\t'.join(split_line))
+                    outfile.write('\n')
+                    rows += 1
+                first = False
+        print(source.rate_message())
+        metrics.add(stage, files=1, rows=rows, num_bytes=source.uncompressed_bytes)
 
-            if toss_zip and os.path.isfile(use_file_name):
-                os.remove(use_file_name)
+    if infer_types:
+        return [] if tracker is None else tracker.typing_tups()
+    return None
 
+
+def concat_all_files_to_bucket(all_files, target_bucket, target_file, program_prefix, extra_cols, file_info_func,
+                               split_more_func, part_size=256 * 1024 * 1024, num_threads=4, spool_dir=None,
+                               infer_types=False, metrics=None):
+    """
+    Same as concat_all_files, but the output goes straight into target_file in target_bucket through a
+    BucketStreamWriter, so the full TSV never has to exist on local disk.
+    """
+    print("building gs://{}/{}".format(target_bucket, target_file))
+    metrics = PipelineMetrics() if metrics is None else metrics
+    stage = metrics.start_stage('concat', total=len(all_files))
+    raw_out = BucketStreamWriter(target_bucket, target_file, part_size, num_threads, spool_dir)
+    with io.TextIOWrapper(io.BufferedWriter(raw_out)) as outfile:
+        try:
+            typing_tups = _concat_all_files_to_handle(outfile, all_files, program_prefix, extra_cols,
+                                                      file_info_func, split_more_func, infer_types, metrics, stage)
+        except BaseException:
+            raw_out.abort()
+            raise
+    metrics.end_stage(stage)
+    print("streamed {} bytes".format(raw_out.bytes_written))
+    return typing_tups
+
+
+def _concat_shard_worker(filename, shard_file, program_prefix, extra_cols, file_info_func, split_more_func,
+                         header_id, hdr_line, tracker):
+    """
+    Process pool worker for concat_all_files: transform the body rows of one file into a shard. Returns
+    the shard file name (None if the input was not found), a status message, the tracker (if any)
+    updated with this shard's rows, and the row and uncompressed byte counts.
+    """
+    use_file_name = _uncompressed_name(filename)
+    source = TextLineSource(filename)
+    rows = 0
+    with source as readfile:
+        if readfile is None:
+            return None, '{} was not found'.format(use_file_name), tracker, 0, 0
+        file_info_list = file_info_func(use_file_name, program_prefix)
+        with open(shard_file, 'w') as outfile:
+            for line in readfile:
+                if line.startswith('#') or line.startswith(header_id):
+                    continue
+                split_line = line.rstrip('\n').split("\t")
+                for i in range(len(extra_cols)):
+                    split_line.append(file_info_list[i])
+                if split_more_func is not None:
+                    split_line = split_more_func(split_line, hdr_line, False)
+                if tracker is not None:
+                    tracker.add_row(split_line)
+                outfile.write('\t'.join(split_line))
+                outfile.write('\n')
+                rows += 1
+    return shard_file, source.rate_message(), tracker, rows, source.uncompressed_bytes
+
+
+def _concat_all_files_parallel(all_files, one_big_tsv, program_prefix, extra_cols, file_info_func,
+                               split_more_func, num_procs, shard_dir, infer_types, metrics, stage):
+    """
+    Pipelined version of concat_all_files. The header is worked out up front from the first data line,
+    just like the serial version does, then workers build the shards while this process stitches the
+    finished ones onto the output in file order. No more than 2 * num_procs files are handed out ahead
+    of the one being stitched, so a slow file does not let finished shards pile up in shard_dir.
+    """
+    print("building {}".format(one_big_tsv))
+    header_id = None
+    hdr_line = None
+    header_out = None
+    tracker = None
+    for filename in all_files:
+        with TextLineSource(filename) as readfile:
+            if readfile is None:
+                continue
+            for line in readfile:
+                if line.startswith('#'):
+                    continue
+                split_line = line.rstrip('\n').split("\t")
+                for col in extra_cols:
+                    split_line.append(col)
+                header_id = split_line[0]
+                hdr_line = split_line
+                print("Header starts with {}".format(header_id))
+                if split_more_func is not None:
+                    split_line = split_more_func(split_line, hdr_line, True)
+                if infer_types:
+                    tracker = ColumnTypeTracker(split_line)
+                header_out = '\t'.join(split_line)
+                break
+        if header_out is not None:
+            break
+
+    if shard_dir is None:
+        shard_dir = os.path.dirname(os.path.abspath(one_big_tsv))
+    work_dir = tempfile.mkdtemp(prefix="concat-shards-", dir=shard_dir)
+    try:
+        with open(one_big_tsv, 'w') as outfile:
+            if header_out is None:
+                return [] if infer_types else None
+            outfile.write(header_out)
+            outfile.write('\n')
+            outfile.flush()
+            metrics.add(stage, rows=1)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_procs) as executor:
+                in_flight = collections.deque()
+                next_file = 0
+                while next_file < len(all_files) or in_flight:
+                    while next_file < len(all_files) and len(in_flight) < 2 * num_procs:
+                        shard_file = os.path.join(work_dir, "shard-{:06d}.tsv".format(next_file))
+                        in_flight.append(executor.submit(_concat_shard_worker, all_files[next_file], shard_file,
+                                                         program_prefix, extra_cols, file_info_func,
+                                                         split_more_func, header_id, hdr_line,
+                                                         None if tracker is None else tracker.empty_copy()))
+                        next_file += 1
+                    future = in_flight.popleft()
+                    shard_file, message, shard_tracker, rows, read_bytes = future.result()
+                    print(message)
+                    if tracker is not None:
+                        tracker.merge(shard_tracker)
+                    if shard_file is None:
+                        metrics.add(stage, files=1, missing=1)
+                        continue
+                    metrics.add(stage, files=1, rows=rows, num_bytes=read_bytes)
+                    with open(shard_file, 'r') as shard_in:
+                        shutil.copyfileobj(shard_in, outfile)
+                    os.remove(shard_file)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if infer_types:
+        return tracker.typing_tups()
     return
 
 
@@ -928,7 +3111,7 @@ def update_schema(target_dataset, dest_table, schema_dict_loc):
     with open(schema_dict_loc, mode='r') as schema_hold_dict:
         full_schema = json_loads(schema_hold_dict.read())
 
-    client = bigquery.Client()
+    client = _bq_client()
     table_ref = client.dataset(target_dataset).table(dest_table)
     table = client.get_table(table_ref)
     orig_schema = table.schema
@@ -946,7 +3129,7 @@ def update_description(target_dataset, dest_table, desc):
     Update the Description of a Table¶
     Final derived table needs a description
     """
-    client = bigquery.Client()
+    client = _bq_client()
     table_ref = client.dataset(target_dataset).table(dest_table)
     table = client.get_table(table_ref)
     table.description = desc
@@ -956,7 +3139,7 @@ def update_description(target_dataset, dest_table, desc):
 
 
 def delete_table_bq_job(target_dataset, delete_table):
-    client = bigquery.Client()
+    client = _bq_client()
     table_ref = client.dataset(target_dataset).table(delete_table)
     try:
         client.delete_table(table_ref)
@@ -1030,7 +3213,7 @@ def transfer_schema(target_dataset, dest_table, source_dataset, source_table):
 
     """
 
-    client = bigquery.Client()
+    client = _bq_client()
     src_table_ref = client.dataset(source_dataset).table(source_table)
     trg_table_ref = client.dataset(target_dataset).table(dest_table)
     src_table = client.get_table(src_table_ref)
@@ -1044,15 +3227,448 @@ def transfer_schema(target_dataset, dest_table, source_dataset, source_table):
     client.update_table(trg_table, ["schema"])
     return True
 
+
+class RateLimiter(object):
+    """
+    Token bucket shared by worker threads. acquire() blocks until another call is allowed, so calls
+    average no more than rate per second, with bursts of up to burst. A rate of None means no limit.
+    waited is the wall time, in seconds, during which at least one call was held back; threads waiting
+    at the same time are not counted twice.
+    """
+    def __init__(self, rate=10.0, burst=1):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._burst = float(max(burst, 1))
+        self._tokens = self._burst
+        self._last = time.monotonic()
+        self._waiting = 0
+        self._wait_since = 0.0
+        self.waited = 0.0
+
+    def __str__(self):
+        return "RateLimiter"
+
+    def acquire(self):
+        if self._rate is None:
+            return
+        held = False
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+                    self._last = now
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        return
+                    wait = (1.0 - self._tokens) / self._rate
+                    if not held:
+                        held = True
+                        if self._waiting == 0:
+                            self._wait_since = now
+                        self._waiting += 1
+                time.sleep(wait)
+        finally:
+            if held:
+                with self._lock:
+                    self._waiting -= 1
+                    if self._waiting == 0:
+                        self.waited += time.monotonic() - self._wait_since
+
+
+def _retryable_bq_error(ex):
+    """
+    Rate limiting and transient server errors from the BigQuery API, which are worth a retry
+    """
+    if isinstance(ex, (exceptions.TooManyRequests, exceptions.InternalServerError, exceptions.BadGateway,
+                       exceptions.ServiceUnavailable, exceptions.GatewayTimeout)):
+        return True
+    return isinstance(ex, exceptions.Forbidden) and 'rateLimitExceeded' in str(ex)
+
+
+def _bq_call_with_retries(limiter, max_retries, func, *args):
+    """
+    Make one rate-limited BigQuery API call, backing off and retrying on _retryable_bq_error. Returns
+    the result and the number of attempts it took.
+    """
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            return func(*args), attempt + 1
+        except Exception as ex:
+            if attempt == max_retries or not _retryable_bq_error(ex):
+                raise
+            time.sleep(min(2 ** attempt, 32))
+
+
+def update_tables_metadata(specs, num_threads=8, max_per_sec=10.0, max_retries=3, metrics=None, verbose=True):
+    """
+    Batch version of update_schema, update_description and transfer_schema, for running over all the
+    tables and views in a release. Each spec is a dict naming the target 'dataset' and 'table', plus
+    at least one of:
+        'schema':      schema dict file to take field descriptions from, as in update_schema
+        'source':      (dataset, table) to copy the schema from, as in transfer_schema
+        'description': new table description, as in update_description
+    Each schema file and source table is read once, however many specs share it. The targets are then
+    updated from num_threads threads, with all API calls held to max_per_sec and retried with backoff
+    on rate-limit and server errors. A target with both a schema and a description still costs one
+    get_table and one update_table; a failed update_table is retried after a fresh get_table.
+    Returns one result dict per spec, in order, with the dataset, table, status ('updated' or
+    'failed'), fields updated, error, retries and seconds taken. Prints a summary if verbose.
+    """
+    limiter = RateLimiter(max_per_sec)
+    client = _bq_client()
+    stage = None if metrics is None else metrics.start_stage('bq_metadata', len(specs))
+
+    #
+    # Read the shared inputs first. A failure here fails just the specs that need that input:
+    #
+
+    schema_dicts = {}
+    for spec in specs:
+        schema_loc = spec.get('schema')
+        if schema_loc is not None and schema_loc not in schema_dicts:
+            try:
+                with open(schema_loc, mode='r') as schema_hold_dict:
+                    schema_dicts[schema_loc] = json_loads(schema_hold_dict.read())
+            except Exception as ex:
+                schema_dicts[schema_loc] = ex
+
+    def get_source(source):
+        try:
+            table_ref = client.dataset(source[0]).table(source[1])
+            return _bq_call_with_retries(limiter, max_retries, client.get_table, table_ref)[0].schema
+        except Exception as ex:
+            return ex
+
+    sources = list(collections.OrderedDict.fromkeys(tuple(spec['source']) for spec in specs
+                                                    if spec.get('source') is not None))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        source_schemas = dict(zip(sources, executor.map(get_source, sources)))
+
+    def update_one(spec):
+        start = time.time()
+        result = {'dataset': spec['dataset'], 'table': spec['table'], 'status': 'failed', 'fields': [],
+                  'error': None, 'retries': 0, 'seconds': 0.0}
+        try:
+            if spec.get('schema') is not None and spec.get('source') is not None:
+                raise ValueError("spec has both a schema file and a source table")
+            if spec.get('schema') is None and spec.get('source') is None and 'description' not in spec:
+                raise ValueError("spec has nothing to update")
+            full_schema = None if spec.get('schema') is None else schema_dicts[spec['schema']]
+            src_schema = None if spec.get('source') is None else source_schemas[tuple(spec['source'])]
+            for loaded in (full_schema, src_schema):
+                if isinstance(loaded, Exception):
+                    raise loaded
+            table_ref = client.dataset(spec['dataset']).table(spec['table'])
+            #
+            # An update_table that fails with a server error may still have been applied, which changes
+            # the etag, so each retry starts again from a fresh get_table rather than resending the old one:
+            #
+            for attempt in range(max_retries + 1):
+                table, attempts = _bq_call_with_retries(limiter, max_retries, client.get_table, table_ref)
+                result['retries'] += attempts - 1
+                fields = []
+                if full_schema is not None:
+                    table.schema = [bigquery.SchemaField(old_sf.name, old_sf.field_type,
+                                                         description=full_schema[old_sf.name]['description'])
+                                    for old_sf in table.schema]
+                    fields.append("schema")
+                elif src_schema is not None:
+                    table.schema = [bigquery.SchemaField(src_sf.name, src_sf.field_type,
+                                                         description=src_sf.description)
+                                    for src_sf in src_schema]
+                    fields.append("schema")
+                if 'description' in spec:
+                    table.description = spec['description']
+                    fields.append("description")
+                limiter.acquire()
+                try:
+                    client.update_table(table, fields)
+                    break
+                except Exception as ex:
+                    if attempt == max_retries or not _retryable_bq_error(ex):
+                        raise
+                    result['retries'] += 1
+                    time.sleep(min(2 ** attempt, 32))
+            result['fields'] = fields
+            result['status'] = 'updated'
+        except Exception as ex:
+            result['error'] = "{}: {}".format(type(ex).__name__, ex)
+        result['seconds'] = time.time() - start
+        if metrics is not None:
+            metrics.add(stage, files=1, failed=0 if result['error'] is None else 1, retries=result['retries'])
+        return result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        results = list(executor.map(update_one, specs))
+
+    if metrics is not None:
+        metrics.end_stage(stage)
+    if verbose:
+        failed = [result for result in results if result['error'] is not None]
+        print("Updated {} of {} tables ({} failed), {:.1f} s spent waiting on the rate limit".format(
+            len(results) - len(failed), len(results), len(failed), limiter.waited))
+        for result in failed:
+            print("FAILED {}.{}: {}".format(result['dataset'], result['table'], result['error']))
+    return results
+
+
 def list_schema(source_dataset, source_table):
     """
     List schema
     """
 
-    client = bigquery.Client()
+    client = _bq_client()
     src_table_ref = client.dataset(source_dataset).table(source_table)
     src_table = client.get_table(src_table_ref)
     src_schema = src_table.schema
     for src_sf in src_schema:
         print(src_sf.name, src_sf.field_type, src_sf.description)
     return True
+
+class _StepOutput(object):
+    """
+    Placeholder for the return value of an earlier PipelineDAG step, filled in when the step runs
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "<output of {}>".format(self.name)
+
+
+_MEMORY_ADDRESS = re.compile(r' at 0x[0-9a-fA-F]+')
+
+
+def _stable_repr(value):
+    """
+    A repr of a PipelineDAG step argument that is the same in every process. Functions and classes
+    are named by module and qualified name, containers are handled element by element, and anything
+    whose repr carries a memory address is refused, since it would never match on a rerun.
+    """
+    if isinstance(value, (list, tuple)):
+        return "{}[{}]".format(type(value).__name__, ", ".join(_stable_repr(item) for item in value))
+    if isinstance(value, dict):
+        return "dict{{{}}}".format(", ".join("{}: {}".format(_stable_repr(key), _stable_repr(val))
+                                             for key, val in sorted(value.items(), key=lambda kv: repr(kv[0]))))
+    if callable(value) and hasattr(value, '__qualname__') and not hasattr(value, '__self__'):
+        return "{}.{}".format(getattr(value, '__module__', ''), value.__qualname__)
+    text = repr(value)
+    if _MEMORY_ADDRESS.search(text):
+        raise Exception("Step argument {} has no stable repr; give add_step a key".format(text))
+    return text
+
+
+class PipelineDAG(object):
+    """
+    Small DAG executor for the GDC-to-BigQuery ETL helpers in this module (manifest, pull list, bucket
+    pull, build_file_list, concat, upload_to_bucket, csv_to_bq, update_schema, update_description...).
+    Each step is a function call plus the steps it depends on. A step's return value can be passed to
+    later steps with output(name). After each step finishes, a checkpoint records a fingerprint of its
+    function, arguments, input files and upstream steps, each upstream step counted by its fingerprint
+    and the time it last finished. On a rerun, up-to-date steps whose outputs still exist are skipped;
+    once a step runs again, everything downstream of it does too. Steps that do not depend on each other
+    (e.g. different tumor types) run concurrently on up to max_workers threads. A step fails if it raises
+    or returns False, and then the steps downstream of it do not run.
+    Function arguments (file_info_func etc.) are fingerprinted by module and qualified name, and plain
+    values by repr. add_step refuses an argument whose repr changes from run to run, such as an object
+    with the default <... at 0x...> repr; pass key= to fingerprint the step on that instead.
+    Results are pickled into the checkpoint so a skipped step hands later steps the same value it
+    returned; a step whose result can't be pickled is always rerun.
+
+        dag = PipelineDAG("etl_checkpoints.json")
+        dag.add_step("files", build_file_list, args=(local_dir,), deps=("pull",))
+        dag.add_step("concat", concat_all_files, args=(dag.output("files"), big_tsv, ...),
+                     deps=("files",), outputs=(big_tsv,))
+        dag.run()
+    """
+    def __init__(self, checkpoint_file, max_workers=4):
+        self._checkpoint_file = checkpoint_file
+        self._max_workers = max_workers
+        self._lock = threading.Lock()
+        self._steps = collections.OrderedDict()
+        self._checkpoints = {}
+        if os.path.isfile(checkpoint_file):
+            with open(checkpoint_file, mode='r') as checkpoint_in:
+                self._checkpoints = json_loads(checkpoint_in.read())
+
+    def __str__(self):
+        return "PipelineDAG"
+
+    def output(self, name):
+        return _StepOutput(name)
+
+    def add_step(self, name, func, args=(), kwargs=None, deps=(), inputs=(), outputs=(), key=None):
+        """
+        inputs and outputs are local files or directories. Changes to inputs make the step rerun; a
+        missing output does too. If key is given, it stands in for args and kwargs in the fingerprint,
+        and the step reruns when the key changes.
+        """
+        if name in self._steps:
+            raise Exception("Duplicate step name {}".format(name))
+        if key is None:
+            _stable_repr((args, {} if kwargs is None else kwargs))
+        self._steps[name] = {
+            'func': func,
+            'args': tuple(args),
+            'kwargs': {} if kwargs is None else dict(kwargs),
+            'deps': tuple(deps),
+            'inputs': tuple(inputs),
+            'outputs': tuple(outputs),
+            'key': key
+        }
+
+    @staticmethod
+    def _path_signature(path):
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            return [path, stat.st_size, stat.st_mtime_ns]
+        if os.path.isdir(path):
+            count = 0
+            total = 0
+            newest = 0
+            for dir_path, _, files in os.walk(path):
+                for f in files:
+                    stat = os.stat(os.path.join(dir_path, f))
+                    count += 1
+                    total += stat.st_size
+                    newest = max(newest, stat.st_mtime_ns)
+            return [path, count, total, newest]
+        return [path, None]
+
+    def _fingerprint(self, name, fingerprints):
+        step = self._steps[name]
+        func = step['func']
+        desc = {
+            'func': "{}.{}".format(getattr(func, '__module__', ''), getattr(func, '__qualname__', repr(func))),
+            'version': 3,
+            'args': _stable_repr(step['args']) if step['key'] is None else None,
+            'kwargs': _stable_repr(step['kwargs']) if step['key'] is None else None,
+            'key': None if step['key'] is None else _stable_repr(step['key']),
+            'inputs': [self._path_signature(path) for path in step['inputs']],
+            # The finish time changes whenever an upstream step reruns, even with the same fingerprint
+            # (e.g. its output was deleted), so that the steps fed by it rerun too:
+            'deps': [[fingerprints[dep], self._checkpoints[dep]['finished']] for dep in step['deps']]
+        }
+        return hashlib.sha256(json_dumps(desc, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _is_up_to_date(self, name, fingerprint):
+        checkpoint = self._checkpoints.get(name)
+        if checkpoint is None or checkpoint['fingerprint'] != fingerprint or 'result_pickle' not in checkpoint:
+            return False
+        return all(os.path.exists(path) for path in self._steps[name]['outputs'])
+
+    def _save_checkpoint(self, name, fingerprint, result, seconds):
+        checkpoint = {'fingerprint': fingerprint, 'finished': time.time(), 'seconds': seconds}
+        try:
+            checkpoint['result_pickle'] = base64.b64encode(pickle.dumps(result)).decode('ascii')
+        except Exception as ex:
+            print("step {} result can't be pickled, so the step will rerun next time: {}".format(name, ex))
+        with self._lock:
+            self._checkpoints[name] = checkpoint
+            tmp_file = "{}.tmp".format(self._checkpoint_file)
+            with open(tmp_file, mode='w') as checkpoint_out:
+                checkpoint_out.write(json_dumps(self._checkpoints))
+            os.replace(tmp_file, self._checkpoint_file)
+
+    def _check_graph(self):
+        for name, step in self._steps.items():
+            for dep in step['deps']:
+                if dep not in self._steps:
+                    raise Exception("Step {} depends on unknown step {}".format(name, dep))
+        visiting = set()
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise Exception("Dependency cycle through step {}".format(name))
+            visiting.add(name)
+            for dep in self._steps[name]['deps']:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self._steps:
+            visit(name)
+
+    def _run_step(self, name, results):
+        step = self._steps[name]
+        args = [results[arg.name] if isinstance(arg, _StepOutput) else arg for arg in step['args']]
+        kwargs = {key: (results[val.name] if isinstance(val, _StepOutput) else val)
+                  for key, val in step['kwargs'].items()}
+        wall_start = time.time()
+        cpu_start = time.thread_time()
+        result = step['func'](*args, **kwargs)
+        return result, time.time() - wall_start, time.thread_time() - cpu_start
+
+    def run(self, force=False):
+        """
+        Run every step that is not up to date. Returns True if all steps succeeded (or were skipped).
+        """
+        self._check_graph()
+        results = {}
+        fingerprints = {}
+        status = {}
+        timings = {}
+        pending = list(self._steps.keys())
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while pending or running:
+                progressed = True
+                while progressed:
+                    progressed = False
+                    for name in list(pending):
+                        deps = self._steps[name]['deps']
+                        if any(status.get(dep) in ('failed', 'blocked') for dep in deps):
+                            status[name] = 'blocked'
+                            pending.remove(name)
+                            print("step {} blocked by a failed upstream step".format(name))
+                            progressed = True
+                            continue
+                        if not all(dep in results for dep in deps):
+                            continue
+                        pending.remove(name)
+                        progressed = True
+                        fingerprints[name] = self._fingerprint(name, fingerprints)
+                        if not force and self._is_up_to_date(name, fingerprints[name]):
+                            results[name] = pickle.loads(base64.b64decode(self._checkpoints[name]['result_pickle']))
+                            status[name] = 'skipped'
+                            timings[name] = (0.0, 0.0)
+                            print("step {} is up to date, skipping".format(name))
+                            continue
+                        print("step {} starting".format(name))
+                        running[executor.submit(self._run_step, name, results)] = name
+
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(list(running.keys()),
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        result, wall_secs, cpu_secs = future.result()
+                    except Exception as ex:
+                        print("step {} failed: {}".format(name, ex))
+                        status[name] = 'failed'
+                        continue
+                    timings[name] = (wall_secs, cpu_secs)
+                    if result is False:
+                        print("step {} returned False after {:.1f} s".format(name, wall_secs))
+                        status[name] = 'failed'
+                        continue
+                    results[name] = result
+                    status[name] = 'done'
+                    self._save_checkpoint(name, fingerprints[name], result, wall_secs)
+                    print("step {} done in {:.1f} s ({:.1f} s CPU)".format(name, wall_secs, cpu_secs))
+
+        print("Pipeline summary:")
+        for name in self._steps:
+            wall_secs, cpu_secs = timings.get(name, (0.0, 0.0))
+            print("   {:<30} {:<8} {:>9.1f} s wall {:>9.1f} s CPU".format(name, status.get(name, 'not run'),
+                                                                        wall_secs, cpu_secs))
+        return all(status.get(name) in ('done', 'skipped') for name in self._steps)